@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""bench_chunker.py: Benchmark splitting FASTA and FASTQ files with Chunker
+
+Compares the parallel splitter (threads > 1) against the single threaded
+Chunker and the previous implementation, which copied the file line by line
+and checked the size of the chunk with fstat at every header. Random FASTA
+and paired FASTQ files are generated in a temporary folder.
+
+Usage:
+> python benchmarks/bench_chunker.py [--size 500] [--chunksize 50M] [--threads 8]
+"""
+
+import os
+import time
+import glob
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+from cerberus_x import Chunker
+
+
+# Previous implementation, kept for comparison
+class LegacyChunker:
+    def __init__(self, path, dest, chunksize='1000M', delim=None, lines=None):
+        self.path = path
+        self.dest = dest
+        self.chunksize = Chunker.human2bytes(chunksize)
+        self.delim = delim
+        self.lines = lines
+        self.name, self.ext = os.path.splitext(os.path.basename(self.path))
+        os.makedirs(dest, exist_ok=True)
+        if self.delim is not None:
+            self.stream_delim()
+        else:
+            self.stream_lines()
+        self.files = sorted(glob.glob(os.path.join(dest, '*')))
+
+    def stream_delim(self):
+        i = 0
+        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
+        with open(self.path, 'r') as inf:
+            for l in inf:
+                if self.delim in l:
+                    fout.flush()
+                    size = os.fstat(fout.fileno()).st_size
+                    if size >= self.chunksize:
+                        fout.close()
+                        i += 1
+                        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
+                fout.write(l)
+            fout.close()
+
+    def stream_lines(self):
+        i = 0
+        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
+        with open(self.path, 'r') as inf:
+            for j, l in enumerate(inf):
+                if j % self.lines == 0:
+                    fout.flush()
+                    size = os.fstat(fout.fileno()).st_size
+                    if size >= self.chunksize:
+                        fout.close()
+                        i += 1
+                        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
+                fout.write(l)
+            fout.close()
+
+
+def random_sequence(length:int):
+    return ''.join(random.choices('ACGT', k=length))
+
+
+def make_fasta(path:Path, size:int):
+    with path.open('w') as writer:
+        i = 0
+        while writer.tell() < size:
+            seq = random_sequence(random.randint(200, 20000))
+            writer.write(f">contig_{i} length={len(seq)}\n")
+            writer.writelines(seq[j:j+80] + '\n' for j in range(0, len(seq), 80))
+            i += 1
+
+
+def make_fastq(path1:Path, path2:Path, size:int):
+    # quality lines can start with '@', as in real reads
+    with path1.open('w') as writer1, path2.open('w') as writer2:
+        i = 0
+        while writer1.tell() < size:
+            for writer in (writer1, writer2):
+                length = random.randint(100, 150)
+                quality = ''.join(random.choices('@ABCDEFGHI#', k=length))
+                writer.write(f"@read_{i}\n{random_sequence(length)}\n+\n{quality}\n")
+            i += 1
+
+
+def bench(name, func, dest:Path, repeat:int):
+    best = None
+    for i in range(repeat):
+        shutil.rmtree(dest, ignore_errors=True)
+        start = time.perf_counter()
+        result = func(dest)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:24}{best:10.3f} s{len(result.files):8} chunks")
+    return best, result
+
+
+def same_content(files:list, original:Path):
+    '''True if the chunks put together are the original file.'''
+    with original.open('rb') as reader:
+        for f in files:
+            with open(f, 'rb') as chunk:
+                data = chunk.read()
+            if reader.read(len(data)) != data:
+                return False
+        return reader.read(1) == b''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=500, help="Size of the generated files, in Megabytes [500]")
+    parser.add_argument('--chunksize', type=str, default='50M', help="Size of the chunks [50M]")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help="Threads of the parallel splitter [all CPUs]")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs, the best time is reported [3]")
+    parser.add_argument('--tmpdir', type=str, default=None, help="Folder for the generated files [system tmp dir]")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed [0]")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    tmp = Path(tempfile.mkdtemp(prefix="bench_chunker_", dir=args.tmpdir))
+    try:
+        fasta = tmp / "contigs.fna"
+        fastq1 = tmp / "reads_R1.fastq"
+        fastq2 = tmp / "reads_R2.fastq"
+        make_fasta(fasta, args.size * 1024**2)
+        make_fastq(fastq1, fastq2, args.size * 1024**2)
+        print(f"FASTA {fasta.stat().st_size/1024**2:.0f} MB, FASTQ 2 x {fastq1.stat().st_size/1024**2:.0f} MB, {args.threads} threads")
+
+        print("FASTA")
+        time_old,old = bench('previous', lambda dest: LegacyChunker(fasta, dest, args.chunksize, '>'), tmp/'old', args.repeat)
+        time_seq,seq = bench('Chunker', lambda dest: Chunker.Chunker(fasta, dest, args.chunksize, '>'), tmp/'seq', args.repeat)
+        time_par,par = bench('Chunker (parallel)', lambda dest: Chunker.Chunker(fasta, dest, args.chunksize, '>', threads=args.threads), tmp/'par', args.repeat)
+        print(f"{'speedup':24}{time_old/time_par:10.1f} x")
+        print(f"chunks are the input: {same_content(par.files, fasta)}")
+
+        print("FASTQ paired")
+        time_old,old = bench('previous (R1 + R2)', lambda dest: [LegacyChunker(fastq2, dest/'R2', args.chunksize, lines=4),
+                                                                 LegacyChunker(fastq1, dest/'R1', args.chunksize, lines=4)][1], tmp/'old', args.repeat)
+        time_seq,seq = bench('Chunker', lambda dest: Chunker.Chunker(fastq1, dest, args.chunksize, lines=4, pair=fastq2), tmp/'seq', args.repeat)
+        time_par,par = bench('Chunker (parallel)', lambda dest: Chunker.Chunker(fastq1, dest, args.chunksize, lines=4, pair=fastq2, threads=args.threads), tmp/'par', args.repeat)
+        print(f"{'speedup':24}{time_old/time_par:10.1f} x")
+        print(f"chunks are the input: {same_content(par.files, fastq1) and same_content(par.pairs, fastq2)}")
+        # the previous implementation splits each file of a pair at different reads
+        reads = [sum(1 for _ in open(f)) // 4 for f in par.files]
+        preads = [sum(1 for _ in open(f)) // 4 for f in par.pairs]
+        print(f"pairs in lockstep: {reads == preads}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""bench_filterHMM.py: Benchmark the overlap resolution of filterHMM
+
+Compares cerberus_hmm.filterHits against the previous implementation, which
+scanned every kept hit of a target for each new hit. Both resolve the hits in
+the order they arrive and keep the same hits. Synthetic hits are placed
+on the proteins of data/example_data, with a number of domains per protein
+drawn at random, and a few repeat proteins with many short domains.
+
+Usage:
+> python benchmarks/bench_filterHMM.py [--repeat 3] [--max-domains 200]
+"""
+
+import time
+import random
+import argparse
+from pathlib import Path
+
+from cerberus_x import cerberus_hmm
+
+
+EXAMPLES = Path(__file__).resolve().parent.parent / "data" / "example_data"
+
+
+# Previous implementation, kept for comparison
+def legacy_filter(hits, dbLookup):
+    BH_target = dict()
+    for target,query,e_value,score,length,start,end in hits:
+        if query not in dbLookup:
+            continue
+        if target not in BH_target:
+            BH_target[target] = [(query, e_value, score, length, start, end)]
+        else:
+            item = (query, e_value, score, length, start, end)
+            add = False
+            overlap = False
+            for c,match in enumerate(BH_target[target]):
+                if start <= match[5] and end >= match[4]:
+                    overlap_len = min(end, match[5]) - max(start, match[4])
+                    if overlap_len > 10:
+                        overlap = True
+                        if e_value == match[1] and score == match[2]:
+                            add = True
+                        elif e_value < match[1]:
+                            BH_target[target][c] = item
+                        elif e_value == match[1]:
+                            if score > match[2]:
+                                BH_target[target][c] = item
+            if add or not overlap:
+                BH_target[target] += [item]
+    return {k:sorted(set(v), key=lambda x: x[4]) for k,v in BH_target.items()}
+
+
+def read_proteins(path:Path):
+    proteins = dict()
+    name = None
+    with path.open() as reader:
+        for line in reader:
+            if line.startswith('>'):
+                name = f"{path.stem}_{line[1:].split()[0]}"
+                proteins[name] = 0
+            elif name:
+                proteins[name] += len(line.strip())
+    return proteins
+
+
+def make_hits(proteins:dict, queries:list, max_domains:int):
+    hits = list()
+    for target,length in proteins.items():
+        if length < 30:
+            continue
+        count = random.choice([0, 1, 1, 2, 3, 5, 8])
+        longest = min(length, 400)
+        if random.random() < 0.01:
+            # repeat protein, many short domains
+            count = max_domains
+            longest = min(length, 60)
+        for i in range(count):
+            size = random.randint(20, longest)
+            start = random.randint(1, length - size + 1)
+            e_value = float(f"{10**-random.uniform(5, 100):.1E}")
+            score = float(f"{random.uniform(20, 500):.1f}")
+            hits.append((target, random.choice(queries), e_value, score, length, start, start+size-1))
+    random.shuffle(hits)
+    return hits
+
+
+def bench(func, hits, dbLookup, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(hits, dbLookup)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs, the best time is reported [3]")
+    parser.add_argument('--max-domains', type=int, default=200, help="Hits on the repeat proteins [200]")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed [0]")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    proteins = dict()
+    for faa in sorted(EXAMPLES.glob("*.faa")):
+        proteins.update(read_proteins(faa))
+    queries = [f"K{i:05d}" for i in range(500)]
+    dbLookup = set(queries[:450])
+    hits = make_hits(proteins, queries, args.max_domains)
+    print(f"{len(proteins)} proteins, {len(hits)} hits")
+
+    time_old,old = bench(legacy_filter, hits, dbLookup, args.repeat)
+    time_new,new = bench(cerberus_hmm.filterHits, hits, dbLookup, args.repeat)
+    print(f"{'previous':12}{time_old:10.3f} s")
+    print(f"{'filterHits':12}{time_new:10.3f} s")
+    print(f"{'speedup':12}{time_old/time_new:10.1f} x")
+
+    # Both keep the same hits, report targets where the sets differ
+    differ = [k for k in old if set(old[k]) != set(new.get(k, []))]
+    print(f"targets: {len(new)}, kept hits: {sum(len(v) for v in new.values())} (previous {sum(len(v) for v in old.values())}), targets differing: {len(differ)}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
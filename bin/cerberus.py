@@ -20,9 +20,11 @@ warnings.warn = warn
 import sys
 import os
 import re
+import math
 from pathlib import Path
 import psutil
 import shutil
+import hashlib
 import subprocess
 import configargparse as argparse #replace argparse with: https://pypi.org/project/ConfigArgParse/
 import pkg_resources as pkg #to import package data files
@@ -37,8 +39,8 @@ import ray #parallel-processing
 from cerberus_x import (
     cerberus_setup,
     cerberus_qc, cerberus_merge, cerberus_trim, cerberus_decon, cerberus_formatFasta, cerberus_metastats,
-    cerberus_genecall, cerberus_hmm, cerberus_parser,
-    cerberus_prostats, cerberus_visual, cerberus_report, Chunker
+    cerberus_genecall, cerberus_hmm, cerberus_parser, cerberus_faidx, cerberus_compress,
+    cerberus_visual, cerberus_report, Chunker
 )
 
 
@@ -47,9 +49,16 @@ from cerberus_x import (
 DEBUG = False
 
 # known file extensions
-FILES_FASTQ = ['.fastq', '.fq']#, '.fastq.gz', '.fq.gz']
+FILES_FASTQ = ['.fastq', '.fq']
 FILES_FASTA = [".fasta", ".fa", ".fna", ".ffn"]
 FILES_AMINO = [".faa"]
+# compressed reads, contigs and proteins, i.e. .fastq.gz
+FILES_FASTQ += [ext+suffix for ext in FILES_FASTQ for suffix in cerberus_compress.SUFFIXES]
+FILES_FASTA += [ext+suffix for ext in FILES_FASTA for suffix in cerberus_compress.SUFFIXES]
+FILES_AMINO += [ext+suffix for ext in FILES_AMINO for suffix in cerberus_compress.SUFFIXES]
+
+# smallest chunk of --chunker auto, in residues (or bytes with --chunk-by size)
+CHUNK_MINSIZE = '100K'
 
 # External file paths
 PATHDB = pkg.resource_filename("cerberus_x", "DB")
@@ -165,6 +174,8 @@ Example:
     output.add_argument('--dir-out', "--dir_out", type=str, default='./results-cerberus', help='path to output directory, defaults to "results-cerberus" in current directory. [./results-cerberus]')
     output.add_argument('--replace', action="store_true", help="Flag to replace existing files. [False]")
     output.add_argument('--keep', action="store_true", help="Flag to keep temporary files. [False]")
+    output.add_argument('--keep-hmmer-raw', action="store_true", help="Flag to also save the unfiltered HMMER hits. [False]")
+    output.add_argument('--compress', action="store_true", help="Compress intermediate FASTQ and FASTA files with gzip. [False]")
     output.add_argument('--tmpdir', type=str, default="", help='temp directory for RAY (experimental) [system tmp dir]')
 
     # Database options
@@ -178,12 +189,21 @@ Example:
     optional.add_argument('--scaffolds', action="store_true", help="Sequences are treated as scaffolds [False]")
     optional.add_argument('--minscore', type=float, default=60, help="Score cutoff for parsing HMMER results [60]")
     optional.add_argument('--evalue', type=float, default=1e-09, help="E-value cutoff for parsing HMMER results [1e-09]")
+    optional.add_argument('--top-hits', type=int, default=5, help="Number of best hits to report per protein and per HMM [5]")
     optional.add_argument('--remove-n-repeats', action="store_true", help="Remove N repeats, splitting contigs [False]")
     optional.add_argument('--skip-decon', action="store_true", help="Skip decontamination step [False]")
     optional.add_argument('--skip-pca', action="store_true", help="Skip PCA [False]")
     optional.add_argument('--cpus', type=int, help="Number of CPUs to use per task. System will try to detect available CPUs if not specified [Auto Detect]")
-    optional.add_argument('--chunker', type=int, default=0, help="Split files into smaller chunks, in Megabytes [Disabled by default]")
+    optional.add_argument('--chunker', type=str, default="0", help="Split files into smaller chunks, in Megabytes, or 'auto' to split into chunks of equal work for the available CPUs [Disabled by default]")
+    optional.add_argument('--chunk-by', type=str, default=None, choices=['residues', 'size'], help="Measure chunks by residues of the sequences or by size of the file [size with --chunker Megabytes, residues with --chunker auto]")
     optional.add_argument('--grouped', action="store_true", help="Group multiple fasta files into a single file before processing. When used with chunker can improve speed")
+    optional.add_argument('--dedup', action="store_true", help="Search identical protein sequences only once, implies --grouped. E-values are computed for the number of proteins of all samples, a stricter --evalue cutoff than searching each sample alone [False]")
+    optional.add_argument('--hit-cache', type=str, default="", help="Path to a file caching HMMER hits between runs, only sequences missing from the cache are searched [Disabled by default]")
+    optional.add_argument('--hit-cache-size', type=int, default=10240, help="Maximum size of the hit cache in Megabytes, least recently used hits are removed [10240]")
+    optional.add_argument('--fuse-search', action="store_true", help="Search the proteins of prodigal in the same task as gene calling, without reading them back from the FAA file. Not used with --grouped or --chunker [False]")
+    optional.add_argument('--min-contig-length', type=int, default=0, help="Skip contigs shorter than this length when calling genes with prodigal, they are counted in the stats [0, Disabled]")
+    optional.add_argument('--genecall-outputs', type=str, default="faa,fna,gff,gbk", help="Comma separated formats written by prodigal, from faa,fna,gff,gbk. The faa and gff are always written, as later steps and the final GFF/GenBank files use them, formats added on a later run are regenerated [faa,fna,gff,gbk]")
+    optional.add_argument('--training-cache', type=str, default="", help="Folder caching pyrodigal training info of single genomes between runs [Output folder of each genome]")
     optional.add_argument('--slurm-nodes', type=str, default="", help=argparse.SUPPRESS)# help='list of node hostnames from SLURM, i.e. $SLURM_JOB_NODELIST.')
     optional.add_argument('--slurm-single', action="store_true", help=argparse.SUPPRESS)# help='Force single node use, do not connect to host')
     optional.add_argument('--version', '-v', action='version',
@@ -253,14 +273,19 @@ Example:
                     DB_HMM[name] = Path(args.db_path, filename)
 
     dbHMM = dict()
+    hmmSearch = dict() # HMM files to search, each searched once
+    hmmViews = dict() # database names (lookup views) sharing the hits of an HMM file
     for hmm in [x.strip(',') for x in set(args.hmm)]:
         if hmm in DB_HMM:
             if DB_HMM[hmm].exists():
+                hmmSearch[hmm] = DB_HMM[hmm]
                 if Path(DB_HMM[hmm]).name.startswith("KOFam"):
                     dbHMM[f"{hmm}_KEGG"] = DB_HMM[hmm]
                     dbHMM[f"{hmm}_FOAM"] = DB_HMM[hmm]
+                    hmmViews[hmm] = [f"{hmm}_KEGG", f"{hmm}_FOAM"]
                 else:
                     dbHMM[hmm] = DB_HMM[hmm]
+                    hmmViews[hmm] = [hmm]
             else:
                 print(f"ERROR: Cannot use '{hmm}', please download it using 'cerberus.py --download")
         else:
@@ -270,6 +295,8 @@ Example:
             if dbpath.exists() and hmm.with_suffix('.tsv').exists():
                 dbname = Path(dbpath).with_suffix('').stem
                 dbHMM[dbname] = dbpath
+                hmmSearch[dbname] = dbpath
+                hmmViews[dbname] = [dbname]
                 print("Loading custom HMM:", dbname, dbpath)
             else:
                 print("Unable to load custom database")
@@ -290,10 +317,21 @@ Example:
     # Check if required flags are set
     if not any([args.prodigal, args.fraggenescan, args.prodigalgv, args.phanotate, args.protein, args.hmmer_tsv]):
         parser.error('At least one sequence must be declared either in the command line or through the config file')
-    if args.chunker < 0:
-        args.chunker = 0
-    if args.grouped and args.chunker == 0:
+    if args.chunker != "auto":
+        try:
+            args.chunker = max(int(args.chunker), 0)
+        except ValueError:
+            parser.error("--chunker must be a whole number of Megabytes or 'auto'")
+    args.genecall_outputs = [x.strip().lower() for x in args.genecall_outputs.split(',') if x.strip()]
+    for ext in args.genecall_outputs:
+        if ext not in cerberus_genecall.GENECALL_OUTPUTS:
+            parser.error(f"--genecall-outputs must be formats from {','.join(cerberus_genecall.GENECALL_OUTPUTS)}")
+    if args.dedup:
+        args.grouped = True
+    if args.grouped and not args.chunker:
         args.chunker = 1
+    if args.chunk_by is None:
+        args.chunk_by = "residues" if args.chunker == "auto" else "size"
 
     # Initialize Config Dictionary
     config = {}
@@ -316,6 +354,12 @@ Example:
     # Create output directory
     config['DIR_OUT'] = os.path.abspath(os.path.expanduser(args.dir_out))
     os.makedirs(config['DIR_OUT'], exist_ok=True)
+    # FASTA indexes and decompressed copies, kept out of the input folders
+    config['DIR_INDEX'] = os.path.join(config['DIR_OUT'], 'index')
+    if args.hit_cache:
+        config['HIT_CACHE'] = os.path.abspath(os.path.expanduser(args.hit_cache))
+    if args.training_cache:
+        config['TRAINING_CACHE'] = os.path.abspath(os.path.expanduser(args.training_cache))
 
     # Sequence File extensions
     config['EXT_FASTA'] = FILES_FASTA
@@ -405,21 +449,21 @@ Example:
     for item in args.protein:
         item = os.path.abspath(os.path.expanduser(item))
         if os.path.isfile(item):
-            name, ext = os.path.splitext(os.path.basename(item))
+            name, ext = cerberus_compress.splitExt(item)
             if ext in FILES_AMINO:
                 amino['Protein_'+name] = item
             else:
                 print(f'{item} is not a valid protein sequence')
         elif os.path.isdir(item):
             for file in os.listdir(item):
-                ext = os.path.splitext(file)[1]
+                ext = cerberus_compress.splitExt(file)[1]
                 if ext in FILES_AMINO:
                     args.protein.append(os.path.join(item, file))
     # Load prodigal-gv input
     for item in args.prodigalgv:
         item = os.path.abspath(os.path.expanduser(item))
         if os.path.isfile(item):
-            name, ext = os.path.splitext(os.path.basename(item))
+            name, ext = cerberus_compress.splitExt(item)
             if ext in FILES_FASTQ:
                 fastq['prodigalgv_'+name] = item
             elif ext in FILES_FASTA:
@@ -428,7 +472,7 @@ Example:
                 print(f"WARNING: Ignoring protein sequence '{item}', please use --protein option for these.")
         elif os.path.isdir(item):
             for file in os.listdir(item):
-                ext = os.path.splitext(file)[1]
+                ext = cerberus_compress.splitExt(file)[1]
                 if ext in FILES_FASTQ + FILES_FASTA:
                     args.prodigalgv.append(os.path.join(item, file))
         else:
@@ -437,7 +481,7 @@ Example:
     for item in args.prodigal:
         item = os.path.abspath(os.path.expanduser(item))
         if os.path.isfile(item):
-            name, ext = os.path.splitext(os.path.basename(item))
+            name, ext = cerberus_compress.splitExt(item)
             if ext in FILES_FASTQ:
                 fastq['prodigal_'+name] = item
             elif ext in FILES_FASTA:
@@ -446,7 +490,7 @@ Example:
                 print(f"WARNING: Ignoring protein sequence '{item}', please use --protein option for these.")
         elif os.path.isdir(item):
             for file in os.listdir(item):
-                ext = os.path.splitext(file)[1]
+                ext = cerberus_compress.splitExt(file)[1]
                 if ext in FILES_FASTQ + FILES_FASTA:
                     args.prodigal.append(os.path.join(item, file))
         else:
@@ -459,7 +503,7 @@ Example:
     for item in args.fraggenescan:
         item = os.path.abspath(os.path.expanduser(item))
         if os.path.isfile(item):
-            name, ext = os.path.splitext(os.path.basename(item))
+            name, ext = cerberus_compress.splitExt(item)
             if ext in FILES_FASTQ:
                 fastq['FragGeneScan_'+name] = item
             elif ext in FILES_FASTA:
@@ -468,7 +512,7 @@ Example:
                 print(f"WARNING: Ignoring protein sequence '{item}', please use --protein option for these.")
         elif os.path.isdir(item):
             for file in os.listdir(item):
-                ext = os.path.splitext(file)[1]
+                ext = cerberus_compress.splitExt(file)[1]
                 if ext in FILES_FASTQ + FILES_FASTA:
                     args.fraggenescan.append(os.path.join(item, file))
         else:
@@ -480,7 +524,7 @@ Example:
     for item in args.phanotate:
         item = os.path.abspath(os.path.expanduser(item))
         if os.path.isfile(item):
-            name, ext = os.path.splitext(os.path.basename(item))
+            name, ext = cerberus_compress.splitExt(item)
             if ext in FILES_FASTQ:
                 fastq['phanotate_'+name] = item
             elif ext in FILES_FASTA:
@@ -489,7 +533,7 @@ Example:
                 print(f"WARNING: Ignoring protein sequence '{item}', please use --protein option for these.")
         elif os.path.isdir(item):
             for file in os.listdir(item):
-                ext = os.path.splitext(file)[1]
+                ext = cerberus_compress.splitExt(file)[1]
                 if ext in FILES_FASTQ + FILES_FASTA:
                     args.phanotate.append(os.path.join(item, file))
         else:
@@ -498,7 +542,7 @@ Example:
     for item in args.hmmer_tsv:
         item = os.path.abspath(os.path.expanduser(item))
         if os.path.isfile(item):
-            name, ext = os.path.splitext(os.path.basename(item))
+            name, ext = cerberus_compress.splitExt(item)
             if ext in ['.tsv']:
                 rollup['rollup_'+name] = item
         else:
@@ -508,6 +552,8 @@ Example:
     print(f"Processing {len(fasta)} fasta sequences")
     print(f"Processing {len(amino)} protein sequences")
     print(f"Processing {len(rollup)} rollup files")
+    # Samples called with pyrodigal, which share the CPUs for gene calling
+    countProdigal = len([key for key in list(fastq) + list(fasta) if key.startswith(("prodigal_", "prodigalgv_"))])
 
     if len(fastq) > 0:
         config['META'] = True
@@ -582,6 +628,9 @@ Example:
     if amino:
         set_add(step_curr, 8, "STEP 8: HMMER Search")
         for key,value in amino.items():
+            # HMMER and the grouped file read plain proteins
+            value = cerberus_compress.plainFile(value, Path(config['DIR_OUT'], STEP[1], key), keep=())
+            amino[key] = value
             pipeline += [ray.put([key, value, 'findORF_'])]
             jobsORF += 1
 
@@ -593,8 +642,8 @@ Example:
         for key,value in rollup.items():
             amino[key] = None
             for hmm in dbHMM:
-                tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, "filtered.tsv")
-                pipeline.append(rayWorkerThread.remote(cerberus_hmm.filterHMM, f"{hmm}/{key}", config['DIR_OUT'], [value, tsv_filtered, dbHMM[hmm]]))
+                tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, f"filtered-{hmm}.tsv")
+                pipeline.append(rayWorkerThread.remote(cerberus_hmm.filterHMM, f"{hmm}/{key}", config['DIR_OUT'], [value, tsv_filtered, dbHMM[hmm], hmm]))
 
     NStats = dict()
     readStats = dict()
@@ -602,15 +651,47 @@ Example:
     final_path = Path(config['DIR_OUT'], "final")
 
     groupIndex = dict()
+    groupSamples = list()
+    dedupIndex = dict()
+    countGrouped = 0
     amino_queue = dict()
     dictChunks = dict()
     countFiltered = dict()
     hmmRollup = {}
     hmmCounts = {}
+    protStats = {}
     if config['CLUSTER']:
         jobs_per_node = 4/config['CPUS']
     else:
         jobs_per_node = 4
+    # Shared by the HTML reports of all samples, written in parallel
+    cerberus_report.copyPlotly(config, STEP[10])
+    # Threads of a gene calling task, which has no chunks to spread over tasks.
+    # The CPUs are shared by the samples, so they are still called in parallel
+    genecallThreads = max(min(int(config['CPUS']), math.ceil(int(config['CPUS']) / max(countProdigal, 1))), 1)
+    # Number of searches that can run at the same time
+    searchSlots = max(int(ray.cluster_resources().get('CPU', config['CPUS']) / jobs_per_node), 1)
+
+    def addFiltered(hmm, key, tsv_filtered):
+        '''Records the filtered hits of a database for a sample, and parses the sample once all databases are filtered.'''
+        tsv_combined = Path(config['DIR_OUT'], STEP[8], key, "filtered.tsv")
+        if key not in hmm_tsvs:
+            hmm_tsvs[key] = dict()
+            with tsv_combined.open('w') as writer:
+                print("target", "query", "e-value", "score", "length", "start", "end", "hmmDB", sep='\t', file=writer)
+        if hmm not in hmm_tsvs[key]:
+            hmm_tsvs[key][hmm] = tsv_filtered
+        with tsv_combined.open('a') as writer, open(tsv_filtered) as reader:
+            reader.readline() # Skip header
+            for line in reader:
+                print(*line.rstrip('\n').split('\t'), hmm, sep='\t', file=writer)
+        if len(hmm_tsvs[key]) == len(dbHMM):
+            # All databases filtered, parse them in a single pass
+            hmm_tsv[key] = tsv_combined
+            hmm_tsvs[key] = {db:hmm_tsvs[key][db] for db in dbHMM}
+            set_add(step_curr, 9, "STEP 9: Parse HMMER results")
+            pipeline.append(rayWorkerThread.remote(cerberus_parser.parseHmmer, key, config['DIR_OUT'], [hmm_tsvs[key], config, f"{STEP[9]}/{key}", dbHMM]))
+        return
     while pipeline:
         ready,pipeline = ray.wait(pipeline, timeout=1)
         if not ready:
@@ -654,12 +735,19 @@ Example:
             elif func == "reformat":
                 fasta[key] = value
             set_add(step_curr, 7, "STEP 7: ORF Finder")
-            if key.startswith("FragGeneScan_"):
+            fuse = config['FUSE_SEARCH'] and not config['GROUPED'] and not config['CHUNKER']
+            if fuse and key.startswith(("prodigalgv_", "prodigal_")):
+                # Gene calling and HMMER search in one task, proteins are passed in memory
+                set_add(step_curr, 8, "STEP 8: HMMER Search")
+                views = {hmm:{view:dbHMM[view] for view in hmmViews[hmm]} for hmm in hmmSearch}
+                pipeline.append(rayWorkerThread.options(num_cpus=genecallThreads).remote(cerberus_genecall.searchORF_prod, key, config['DIR_OUT'],
+                                                        [fasta[key], config, f"{STEP[7]}/{key}", config['META'], key.startswith("prodigalgv_"), genecallThreads, Path(STEP[8]), hmmSearch, views]))
+            elif key.startswith("FragGeneScan_"):
                 pipeline.append(rayWorkerThread.remote(cerberus_genecall.findORF_fgs, key, config['DIR_OUT'], [fasta[key], config, f"{STEP[7]}/{key}"]))
             elif key.startswith("prodigalgv_"):
-                pipeline.append(rayWorkerThread.remote(cerberus_genecall.findORF_prod, key, config['DIR_OUT'], [fasta[key], config, f"{STEP[7]}/{key}", config['META'], True]))
+                pipeline.append(rayWorkerThread.options(num_cpus=genecallThreads).remote(cerberus_genecall.findORF_prod, key, config['DIR_OUT'], [fasta[key], config, f"{STEP[7]}/{key}", config['META'], True, genecallThreads]))
             elif key.startswith("prodigal_"):
-                pipeline.append(rayWorkerThread.remote(cerberus_genecall.findORF_prod, key, config['DIR_OUT'], [fasta[key], config, f"{STEP[7]}/{key}", config['META']]))
+                pipeline.append(rayWorkerThread.options(num_cpus=genecallThreads).remote(cerberus_genecall.findORF_prod, key, config['DIR_OUT'], [fasta[key], config, f"{STEP[7]}/{key}", config['META'], False, genecallThreads]))
             elif key.startswith("phanotate_"):
                 pipeline.append(rayWorkerThread.remote(cerberus_genecall.findORF_phanotate, key, config['DIR_OUT'], [fasta[key], config, f"{STEP[7]}/{key}", config['META']]))
             jobsORF += 1
@@ -679,124 +767,142 @@ Example:
                     Path(config['DIR_OUT'], 'grouped').mkdir(parents=True, exist_ok=True)
                 outfile = Path(config['DIR_OUT'], 'grouped', 'grouped.faa')
                 Path(config['DIR_OUT'], STEP[8], key).mkdir(parents=True, exist_ok=True)
-                with outfile.open('a') as writer, Path(value).open() as reader:
-                    for line in reader:
-                        writer.write(line)
-                        if line.startswith('>'):
-                            name = line[1:].rstrip().split()[0]
+                groupSamples.append(key)
+                if config['DEDUP']:
+                    # Write each distinct sequence once, named by its hash
+                    with cerberus_faidx.FastaIndex(value, config['DIR_INDEX']) as faa_index, outfile.open('ab') as writer:
+                        countGrouped += len(faa_index)
+                        for name in faa_index:
+                            seqhash = hashlib.md5(faa_index.sequence(name, binary=True)).hexdigest()
+                            if seqhash not in dedupIndex:
+                                dedupIndex[seqhash] = list()
+                                seq = faa_index.lines(name)
+                                writer.write(f">{seqhash}\n".encode())
+                                writer.write(seq)
+                                if len(seq) and seq[-1] != ord('\n'):
+                                    writer.write(b'\n')
+                                seq.release()
+                            dedupIndex[seqhash] += [(key, name)]
+                else:
+                    with cerberus_faidx.FastaIndex(value, config['DIR_INDEX']) as faa_index:
+                        countGrouped += len(faa_index)
+                        for name in faa_index:
                             if name in groupIndex:
                                 print("WARN: Duplicate header:", name)
                             groupIndex[name] = key
+                    with outfile.open('ab') as writer, Path(value).open('rb') as reader:
+                        shutil.copyfileobj(reader, writer)
                 if jobsORF > 0:
                     continue #Continue until all ORFs are done
                 value = outfile
                 key = "grouped"
+                if config['DEDUP']:
+                    print(f"Searching {len(dedupIndex)} distinct sequences of {countGrouped} proteins")
             set_add(step_curr, 8, "STEP 8: HMMER Search")
             amino[key] = value
-            if config['CHUNKER'] > 0:
-                chunks = Chunker.Chunker(amino[key], os.path.join(config['DIR_OUT'], 'chunks', key), f"{config['CHUNKER']}M", '>')
-                for hmm in dbHMM.items():
-                    chunkCount = 1
-                    for chunk in chunks.files:
-                        key_chunk = f'chunk-{hmm[0]}-{chunkCount}-{len(chunks.files)}_{key}'
-                        key_name = f'chunk-{chunkCount}-{len(chunks.files)}_{key}'
-                        chunkCount += 1
-                        pipeline.append(rayWorkerThread.options(num_cpus=jobs_per_node).remote(cerberus_hmm.searchHMM, [key_chunk], config['DIR_OUT'],
-                                                                                [{key_name:chunk}, config, Path(STEP[8], key), hmm, 4]))
-            else:
-                outfile = Path(config['DIR_OUT'], STEP[8], key, f'{key}.tsv')
-                if config['REPLACE'] or not outfile.exists(): #TODO: Possible bug, will always be true
-                    for hmm in dbHMM.items():
-                        hmm_key = f"{hmm[0]}/{key}"
-                        pipeline.append(rayWorkerThread.options(num_cpus=jobs_per_node).remote(cerberus_hmm.searchHMM, [hmm_key], config['DIR_OUT'],
-                                                                [{key:value}, config, Path(STEP[8]), hmm, 4]))
+            # E-values of deduplicated proteins are computed for the number of proteins of all samples (before deduplication),
+            # instead of the distinct sequences of each chunk. Grouped proteins keep the sequences of each chunk
+            Z = countGrouped if key == "grouped" and config['DEDUP'] else None
+            if config['CHUNKER']:
+                # Virtual chunks, each search reads its byte range of the amino acid file
+                chunk_path = os.path.join(config['DIR_OUT'], 'chunks', key)
+                if config['CHUNKER'] == "auto":
+                    # Enough chunks for every search slot to get two tasks
+                    chunks = Chunker.Chunker(amino[key], chunk_path, delim='>', cost=config['CHUNK_BY'],
+                                             chunks=math.ceil(2 * searchSlots / len(hmmSearch)), minsize=CHUNK_MINSIZE, virtual=True)
                 else:
-                    #TODO: distinguish filtered tsv per hmm
-                    tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, "filtered.tsv")
-                    set_add(step_curr, 8.1, "STEP 8: Filtering HMMER results")
-                    pipeline.append(rayWorkerThread.remote(cerberus_hmm.filterHMM, key, config['DIR_OUT'], [tsv_out, tsv_filtered, dbHMM[hmm]]))
+                    chunks = Chunker.Chunker(amino[key], chunk_path, f"{config['CHUNKER']}M", '>', cost=config['CHUNK_BY'], virtual=True)
+                # Submit the largest searches first, by size of the chunk and of the HMM file
+                tasks = list()
+                for hmm in hmmSearch.items():
+                    for chunkCount,(chunk,cost) in enumerate(zip(chunks.files, chunks.costs), 1):
+                        tasks.append((cost * os.path.getsize(hmm[1]), chunkCount, chunk, hmm))
+                for _,chunkCount,chunk,hmm in sorted(tasks, key=lambda x: x[0], reverse=True):
+                    key_chunk = f'chunk-{hmm[0]}-{chunkCount}-{len(chunks.files)}_{key}'
+                    key_name = f'chunk-{chunkCount}-{len(chunks.files)}_{key}'
+                    views = {view:dbHMM[view] for view in hmmViews[hmm[0]]}
+                    pipeline.append(rayWorkerThread.options(num_cpus=jobs_per_node).remote(cerberus_hmm.searchHMM, [key_chunk], config['DIR_OUT'],
+                                                                            [{key_name:chunk}, config, Path(STEP[8], key), hmm, 4, views, Z]))
+            else:
+                for hmm in hmmSearch.items():
+                    hmm_key = f"{hmm[0]}/{key}"
+                    views = {view:dbHMM[view] for view in hmmViews[hmm[0]]}
+                    pipeline.append(rayWorkerThread.options(num_cpus=jobs_per_node).remote(cerberus_hmm.searchHMM, [hmm_key], config['DIR_OUT'],
+                                                            [{key:value}, config, Path(STEP[8]), hmm, 4, views, Z]))
+        if func == "searchORF_prod":
+            faa,searched = value
+            if faa.stat().st_size == 0:
+                print("WARNING: no ORFs found in:", key, faa)
+                continue
+            amino[key] = faa
+            set_add(step_curr, 8.1, "STEP 8: Filtering HMMER results")
+            for tsv_files in searched.values():
+                for view,tsv_filtered in tsv_files.items():
+                    addFiltered(view, key, tsv_filtered)
         if func.startswith('searchHMM'):
+            # searchHMM returns the hits already filtered per database view
             keys = key
-            for key,tsv_file in zip(keys,value):
+            for key,tsv_files in zip(keys,value):
                 match = re.search(r"^chunk-([A-Za-z_]+)-(\d+)-(\d+)_(.+)", key)
                 if match: # Matches if the keys are part of chunks
                     hmm,i,l,key = match.groups()
                     hmm_key = f"{hmm}-{key}"
                     if hmm_key not in dictChunks:
                         dictChunks[hmm_key] = list()
-                    dictChunks[hmm_key].append(tsv_file)
+                    dictChunks[hmm_key].append(tsv_files)
                     if len(dictChunks[hmm_key]) == int(l):
                         # All chunks of a file have returned
+                        set_add(step_curr, 8.1, "STEP 8: Filtering HMMER results")
                         if config['GROUPED']:
-                            key_set = set()
-                            for item in sorted(dictChunks[hmm_key]):
-                                with open(item) as reader:
-                                    for line in reader:
-                                        name = line.split()[0]
-                                        k = groupIndex[name]
-                                        key_set.add(k)
-                                        tsv_out = Path(config['DIR_OUT'], STEP[8], k, f"{hmm}-{k}.tsv")
-                                        with tsv_out.open('a') as writer:
-                                            writer.write(line)
-                                dictChunks[hmm_key].remove(item)
-                                if not config['KEEP']:
-                                    os.remove(item)
-                            set_add(step_curr, 8.1, "STEP 8: Filtering HMMER results")
-                            for k in key_set:
-                                tsv_out = Path(config['DIR_OUT'], STEP[8], k, f"{hmm}-{k}.tsv")
-                                tsv_filtered = Path(config['DIR_OUT'], STEP[8], k, f"filtered-{hmm}.tsv")
-                                pipeline.append(rayWorkerThread.remote(cerberus_hmm.filterHMM, f"{hmm}/{k}", config['DIR_OUT'], [tsv_out, tsv_filtered, dbHMM[hmm]]))
+                            for view in hmmViews[hmm]:
+                                # Filtered hits of each sample of the group
+                                groupHits = {k:list() for k in groupSamples}
+                                for item in sorted([x[view] for x in dictChunks[hmm_key]]):
+                                    with open(item) as reader:
+                                        reader.readline() # Skip header
+                                        for line in reader:
+                                            name,hit = line.split('\t', 1)
+                                            if config['DEDUP']:
+                                                # Expand hits of a distinct sequence to each of its proteins
+                                                for k,target in dedupIndex[name]:
+                                                    groupHits[k].append(f"{target}\t{hit}")
+                                            else:
+                                                groupHits[groupIndex[name]].append(line)
+                                    if not config['KEEP']:
+                                        os.remove(item)
+                                for k,lines in groupHits.items():
+                                    tsv_filtered = Path(config['DIR_OUT'], STEP[8], k, f"filtered-{view}.tsv")
+                                    with tsv_filtered.open('w') as writer:
+                                        print("target", "query", "e-value", "score", "length", "start", "end", sep='\t', file=writer)
+                                        writer.writelines(lines)
+                                    addFiltered(view, k, tsv_filtered)
+                                del groupHits
+                            del dictChunks[hmm_key]
                             # FINISH SPLITTING GROUP
                             continue
                         # Not grouped
-                        tsv_out = Path(config['DIR_OUT'], STEP[8], key, f"{hmm}-{key}.tsv")
-                        tsv_out.parent.mkdir(parents=True, exist_ok=True)
-                        with tsv_out.open('w') as writer:
-                            for item in sorted(dictChunks[hmm_key]):
-                                writer.write(open(item).read())
-                                dictChunks[hmm_key].remove(item)
-                                if not config['KEEP']:
-                                    os.remove(item)
-                        tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, f"filtered-{hmm}.tsv")
-                        set_add(step_curr, 8.1, "STEP 8: Filtering HMMER results")
-                        pipeline.append(rayWorkerThread.remote(cerberus_hmm.filterHMM, f"{hmm}/{key}", config['DIR_OUT'], [tsv_out, tsv_filtered, dbHMM[hmm]]))
+                        for view in hmmViews[hmm]:
+                            tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, f"filtered-{view}.tsv")
+                            tsv_filtered.parent.mkdir(parents=True, exist_ok=True)
+                            with tsv_filtered.open('w') as writer:
+                                print("target", "query", "e-value", "score", "length", "start", "end", sep='\t', file=writer)
+                                for item in sorted([x[view] for x in dictChunks[hmm_key]]):
+                                    with open(item) as reader:
+                                        reader.readline() # Skip header
+                                        shutil.copyfileobj(reader, writer)
+                                    if not config['KEEP']:
+                                        os.remove(item)
+                            addFiltered(view, key, tsv_filtered)
+                        del dictChunks[hmm_key]
                 else:
                 # Not chunked file
                     hmm,key = key.split(sep='/', maxsplit=1)
-                    tsv_out = Path(config['DIR_OUT'], STEP[8], key, f"{hmm}-{key}.tsv")
-                    with tsv_out.open('w') as writer:
-                        writer.write(open(tsv_file).read())
-                    if not config['KEEP']:
-                            os.remove(tsv_file)
                     set_add(step_curr, 8.1, "STEP 8: Filtering HMMER results")
-                    tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, f"filtered-{hmm}.tsv")
-                    pipeline.append(rayWorkerThread.remote(cerberus_hmm.filterHMM, f"{hmm}/{key}", config['DIR_OUT'], [tsv_out, tsv_filtered, dbHMM[hmm]]))
+                    for view,tsv_filtered in tsv_files.items():
+                        addFiltered(view, key, tsv_filtered)
         if func.startswith('filterHMM'):
             hmm,key = key.split('/')
-            set_add(step_curr, 9, "STEP 9: Parse HMMER results")
-            pipeline.append(rayWorkerThread.remote(cerberus_parser.parseHmmer, key, config['DIR_OUT'], [value, config, f"{STEP[9]}/{key}", hmm, dbHMM[hmm]]))
-            
-            tsv_filtered = Path(config['DIR_OUT'], STEP[8], key, "filtered.tsv")
-            if key not in hmm_tsvs:
-                hmm_tsvs[key] = dict()
-                with tsv_filtered.open('w') as writer:
-                    print("target", "query", "e-value", "score", "length", "start", "end", "hmmDB", sep='\t', file=writer)
-            if hmm not in hmm_tsvs[key]:
-                hmm_tsvs[key][hmm] = value
-            with tsv_filtered.open('a') as writer, open(value) as reader:
-                reader.readline() # Skip header
-                for line in reader:
-                    print(*line.rstrip('\n').split('\t'), hmm, sep='\t', file=writer)
-            if len(hmm_tsvs[key]) == len(dbHMM):
-                # old method
-                hmm_tsv[key] = tsv_filtered
-                outfile = Path(config['DIR_OUT'], STEP[9], key, f"top_5-{key}.tsv")
-                pipeline.append(rayWorkerThread.remote(cerberus_parser.top5, key, config['DIR_OUT'],
-                                                       [tsv_filtered, outfile]))
-                # new method
-                outfile = Path(config['DIR_OUT'], STEP[9], key, "HMMER_top_5.tsv")
-                pipeline.append(rayWorkerThread.remote(cerberus_parser.top5s, key, config['DIR_OUT'],
-                                                       [hmm_tsvs[key], outfile]))
+            addFiltered(hmm, key, value)
         if func.startswith('parseHmmer'):
             if key not in hmmRollup:
                 hmmRollup[key] = dict()
@@ -806,6 +912,14 @@ Example:
             if key not in hmmCounts:
                 hmmCounts[key] = dict()
             hmmCounts[key].update(value)
+            # Sample is complete, write its final reports
+            set_add(step_curr, 10, "STEP 10: Creating Reports")
+            pipeline.append(rayWorkerThread.remote(cerberus_report.write_sample, key, config['DIR_OUT'],
+                                                   [key, amino[key], fasta.get(key), hmm_tsvs[key], hmmCounts[key], config, dbHMM, final_path]))
+            pipeline.append(rayWorkerThread.remote(cerberus_report.write_sampleReport, key, config['DIR_OUT'],
+                                                   [key, hmmRollup[key], hmmCounts[key], config, STEP[10], final_path]))
+        if func == "write_sample":
+            protStats[key] = value
 
     # End main pipeline
 
@@ -814,77 +928,13 @@ Example:
     logTime(config["DIR_OUT"], socket.gethostname(), "Pipeline_time", config["DIR_OUT"], time_pipeline)
 
     # step 10 (Report)
-    print("\nSTEP 10: Creating Reports")
-
-    ## Copy report files from QC, Parser
-    #for key in hmmRollup.keys():
-    #    Path(report_path, key).mkdir(0o777, True, True)
-    #    src = os.path.join(config['DIR_OUT'], config['STEP'][9], key, "HMMER_top_5.tsv")
-    #    dst = os.path.join(report_path, key)
-    #    shutil.copy(src, dst)
+    print("\nSTEP 10: Creating Combined Reports")
 
     # Write Stats
-    Path(final_path, "fasta").mkdir(0o777, True, True)
-    print("Creating final reports and statistics")
-    protStats = {}
-    for key in hmm_tsvs.keys():
-        # Copy report files from QC, Parser
-        Path(report_path, key).mkdir(0o777, True, True)
-        Path(final_path, key).mkdir(0o777, True, True)
-        src = os.path.join(config['DIR_OUT'], config['STEP'][9], key, "HMMER_top_5.tsv")
-        dst = Path(final_path, key)
-        shutil.copy(src, dst)
-        # Protein statistics & annotation summary
-        summary_tsv = Path(final_path, key, 'final_annotation_summary.tsv')
-        protStats[key] = cerberus_prostats.getStats(amino[key], hmm_tsvs[key], hmmCounts[key], config, dbHMM, summary_tsv, Path(final_path, "fasta", f"{key}.faa"))
-        try:
-            src = Path(amino[key]).with_suffix(".ffn")
-            dst = Path(final_path, "fasta", f"{key}.ffn")
-            shutil.copy(src, dst)
-        except: pass
-        try:
-            src = Path(fasta[key])
-            dst = Path(final_path, "fasta", f"{key}.fna")
-            shutil.copy(src, dst)
-        except: pass
-        # Create GFFs #TODO: Incorporate this into getStats (or separate all summary into new module)
-        gff = [x for x in Path(config['DIR_OUT'], STEP[7], key).glob("*.gff")]
-        Path(final_path, "gff").mkdir(511, True, True)
-        if len(gff) == 1:
-            out_gff = Path(final_path, "gff", f"{key}.gff")
-            out_genbank = Path(final_path, f"{key}_template.gbk")
-            cerberus_report.write_datafiles(gff[0], fasta[key], amino[key], summary_tsv, out_gff, out_genbank)
-        else:
-            out_gff = Path(final_path, "gff", f"{key}.gff")
-            with out_gff.open('w') as writer:
-                with summary_tsv.open() as read_summary:
-                    read_summary.readline()
-                    print("##gff-version  3", file=writer)
-                    for summ in read_summary:
-                        summ = summ.split('\t')
-                        data = [summ[0].split('_')[0], ".", ".", ".", ".", ".", ".", ".", ]
-                        attributes = ';'.join([f"ID={summ[0]}", f"Name={summ[1]}", f"Alias={summ[2]}", f"Dbxref={summ[3]}", f"evalue={summ[4]}", f"product_start={summ[8]}", f"product_end={summ[9]}", f"product_length={summ[10]}"])
-                        print(*data, attributes, sep='\t', file=writer)
-                try:
-                    with open(fasta[key]) as read_fasta:
-                        print("##FASTA", file=writer)
-                        for line in read_fasta:
-                            writer.write(line)
-                except: pass
+    protStats = {key:protStats[key] for key in hmm_tsvs.keys() if key in protStats}
     cerberus_report.write_Stats(report_path, readStats, protStats, NStats, config)
     del protStats
 
-    # Write Roll-up Tables
-    print("Creating Rollup Tables")
-    for sample,tables in hmmCounts.items():
-        os.makedirs(f"{report_path}/{sample}", exist_ok=True)
-        for name,table in tables.items():
-            cerberus_report.writeTables(table, f"{report_path}/{sample}/{name}")
-    for sample,tables in hmmRollup.items():
-        os.makedirs(f"{report_path}/{sample}", exist_ok=True)
-        for name,table in tables.items():
-            shutil.copy(table, Path(final_path, sample, f'rollup_{name}.tsv'))
-
     # Counts Tables
     print("Mergeing Count Tables")
     dfCounts = dict()
@@ -957,30 +1007,6 @@ Example:
         if not is_internet:
             print(f"GAGE and Pathview require internet access to run. Run the script '{rscript}'")
 
-    # Figure outputs (HTML)
-    print("Creating combined sunburst and bargraphs")
-    figSunburst = {}
-    for key,value in hmmCounts.items():
-        figSunburst[key] = cerberus_visual.graphSunburst(value)
-
-    #@ray.remote
-    #def graphCharts(key, rollup, counts):
-    #    return key, cerberus_visual.graphBarcharts(rollup, counts)
-    
-    jobCharts = []
-    for key,value in hmmRollup.items():
-        #jobCharts.append( graphCharts.remote(key, value, hmmCounts[key]) )
-        jobCharts.append( rayWorkerThread.remote(cerberus_visual.graphBarcharts, key, config['DIR_OUT'], [value, hmmCounts[key]]) )
-    
-    figCharts = {}
-    while(jobCharts):
-        ready,jobCharts = ray.wait(jobCharts)
-        if ready:
-            key,value,_ = ray.get(ready[0])
-            figCharts[key] = value
-
-    cerberus_report.createReport(figSunburst, figCharts, config, STEP[10])
-
     # Finished!
     print("\nFinished Pipeline")
     end = str(datetime.timedelta(seconds=time.time()-startTime))
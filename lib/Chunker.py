@@ -4,76 +4,291 @@ Takes into account headers begining with select delimeters (i.e. > or @)
 """
 
 import os
+import mmap
+import bisect
 import argparse
-import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from . import cerberus_compress
+except ImportError:
+    # run as a script
+    import cerberus_compress
+
+
+# bytes read or written at once by the parallel splitter
+BLOCK = 1 << 24
 
 
 class Chunker:
+    '''Split a file into chunks of about chunksize.
 
-    def __init__(self, path, dest, chunksize='1000M', delim=None, lines=None):
+    cost is how chunks are measured: 'size' in bytes of the file, or 'residues'
+    in letters of the sequences, without headers and line breaks. If chunks is
+    given, chunksize is set to split the file into that many chunks of equal
+    cost, but no smaller than minsize.
+    If virtual is True, no chunk is written and files holds the byte range
+    (path, start, end) of each chunk in the file instead of a path.
+    The cost of each chunk is kept in costs, in the order of files.
+
+    pair is the second file of paired reads (with lines), split in lockstep
+    with the records of the first file into pairs.
+    With cost 'size', the file is split at byte offsets moved to the next
+    record instead of line by line. With threads > 1, the offsets are found
+    in parallel and the chunks written concurrently.
+    Compressed files (gzip, zstd) are streamed line by line, and sizes are of
+    the decompressed data. If compress is True, chunks are written with gzip.
+    '''
+    def __init__(self, path, dest, chunksize='1000M', delim=None, lines=None, cost='size', chunks=None, minsize='0B', virtual=False,
+                 pair=None, threads=1, compress=False):
         self.path = path
         self.dest = dest
         self.chunksize = human2bytes(chunksize)
         self.delim = delim
         self.lines = lines
+        self.cost = cost
+        self.virtual = virtual
+        self.pair = pair
+        self.threads = threads
+        self.compress = compress
+        self.compressed = cerberus_compress.compression(path) is not None
+        self.files = list()
+        self.pairs = list()
+        self.costs = list()
 
         self.fn = os.path.basename(self.path)
-        self.name, self.ext = os.path.splitext(self.fn)
+        self.name, self.ext = cerberus_compress.splitExt(self.fn)
+        self.bdelim = delim.encode() if delim is not None else None
+        if pair is not None and self.bdelim is not None:
+            raise ValueError("Paired files must be split by lines.")
+        if virtual and self.compressed:
+            raise ValueError("Virtual chunks need an uncompressed file.")
 
         #if os.path.exists(dest):
         #    if os.listdir(dest):
         #        raise IOError("Destination folder not empty.")
 
-        os.makedirs(dest, exist_ok=True)
-
-        self.stream()
-        self.files = glob.glob(os.path.join(dest, '*'))
+        if not virtual:
+            os.makedirs(dest, exist_ok=True)
 
-    def stream(self):
-        if self.delim is not None:
-            self.stream_delim()
+        if chunks:
+            self.chunksize = max(-(-self.total() // chunks), human2bytes(minsize), 1)
+        if cost == 'size' and not self.compressed and (threads > 1 or self.bdelim is not None):
+            self.stream_offsets()
         else:
-            self.stream_lines()
+            self.stream()
 
-    def stream_delim(self):
-        i = 0
-        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
-        with open(self.path, 'r') as inf:
-            for l in inf:
-                if self.delim in l:
-                    # check filesize, potentially increase i
-                    fout.flush()
-                    size = os.fstat(fout.fileno()).st_size
-                    if size >= self.chunksize:
-                        fout.close()
-                        i += 1
-                        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
-                        fout.write(l)
-                    else:
-                        fout.write(l)
-                else:
-                    fout.write(l)
-            fout.close()
+    def total(self):
+        '''Cost of the whole file.'''
+        if self.cost == 'size' and not self.compressed:
+            return os.path.getsize(self.path)
+        total = 0
+        with cerberus_compress.openFile(self.path, 'rb', self.threads) as inf:
+            for j, l in enumerate(inf):
+                total += self.measure(j, l)
+        return total
+
+    def header(self, j, l):
+        '''True if line j starts a text group.'''
+        if self.bdelim is not None:
+            return self.bdelim in l
+        return j % self.lines == 0
+
+    def measure(self, j, l):
+        '''Cost of line j.'''
+        if self.cost == 'size':
+            return len(l)
+        if self.bdelim is not None:
+            return 0 if self.header(j, l) else len(l.strip())
+        # only the sequence line of each group, i.e. not the quality line of fastq
+        return len(l.strip()) if j % self.lines == 1 else 0
 
-    def stream_lines(self):
+    def chunkName(self, path, i):
+        name, ext = cerberus_compress.splitExt(path)
+        if cerberus_compress.compression(path):
+            ext = os.path.splitext(ext)[0]
+        return os.path.join(self.dest, '%s.%05d%s' % (name, i, cerberus_compress.outputExt(ext, self.compress)))
+
+    def stream(self):
         i = 0
-        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
-        with open(self.path, 'r') as inf:
+        size = 0
+        start = 0
+        pos = 0
+        pstart = 0
+        ppos = 0
+        # header() and measure(), inlined
+        chunksize = self.chunksize
+        delim = self.bdelim
+        lines = self.lines
+        by_size = self.cost == 'size'
+        fout = self.open(self.path, i)
+        pout = self.open(self.pair, i)
+        pinf = cerberus_compress.openFile(self.pair, 'rb', self.threads) if self.pair is not None else None
+        with cerberus_compress.openFile(self.path, 'rb', self.threads) as inf:
             for j, l in enumerate(inf):
-                if j % self.lines == 0:
-                    # check filesize, potentially increase i
-                    fout.flush()
-                    size = os.fstat(fout.fileno()).st_size
-                    if size >= self.chunksize:
-                        fout.close()
-                        i += 1
-                        fout = open(os.path.join(self.dest, '%s.%05d%s' % (self.name, i, self.ext)), 'w')
-                        fout.write(l)
-                    else:
-                        fout.write(l)
-                else:
+                head = delim in l if delim is not None else j % lines == 0
+                if head and size >= chunksize:
+                    # chunk is full, start the next one at this text group
+                    self.close(i, fout, pout, (start, pos), (pstart, ppos), size)
+                    i += 1
+                    size = 0
+                    start = pos
+                    pstart = ppos
+                    fout = self.open(self.path, i)
+                    pout = self.open(self.pair, i)
+                if fout is not None:
                     fout.write(l)
+                if by_size:
+                    size += len(l)
+                elif delim is not None and not head or delim is None and j % lines == 1:
+                    size += len(l.strip())
+                pos += len(l)
+                if pinf is not None:
+                    # same line of the paired file
+                    l = pinf.readline()
+                    if pout is not None:
+                        pout.write(l)
+                    ppos += len(l)
+        if pinf is not None:
+            pinf.close()
+        self.close(i, fout, pout, (start, pos), (pstart, ppos), size)
+
+    def open(self, path, i):
+        '''Open the file of chunk i of path, None if chunks are virtual.'''
+        if self.virtual or path is None:
+            return None
+        if self.compress:
+            return cerberus_compress.openFile(self.chunkName(path, i), 'wb')
+        return open(self.chunkName(path, i), 'wb', buffering=BLOCK)
+
+    def close(self, i, fout, pout, span, pspan, size):
+        '''Add finished chunk i, spanning bytes span of the file and pspan of the paired file.'''
+        if fout is None:
+            self.files.append((self.path, *span))
+        else:
             fout.close()
+            self.files.append(self.chunkName(self.path, i))
+        if self.pair is not None:
+            if pout is None:
+                self.pairs.append((self.pair, *pspan))
+            else:
+                pout.close()
+                self.pairs.append(self.chunkName(self.pair, i))
+        self.costs.append(size)
+
+    def stream_offsets(self):
+        '''Split at byte offsets moved to the next record, and write the chunks concurrently.'''
+        size = os.path.getsize(self.path)
+        count = max(-(-size // self.chunksize), 1)
+        with ThreadPoolExecutor(self.threads) as pool, MappedFile(self.path) as data, MappedFile(self.pair) as pdata:
+            targets = [size * i // count for i in range(count + 1)]
+            if self.bdelim is not None and self.threads == 1:
+                # the first record after each chunksize, as when streaming lines
+                bounds = [nextRecord(data, self.chunksize, self.bdelim)]
+                while bounds[-1] < size:
+                    bounds.append(nextRecord(data, bounds[-1] + self.chunksize, self.bdelim))
+                pbounds = None
+            elif self.bdelim is not None:
+                bounds = list(pool.map(lambda pos: nextRecord(data, pos, self.bdelim), targets[1:-1]))
+                pbounds = None
+            else:
+                # record number at each target, from the line breaks before it
+                breaks = np.cumsum([0] + list(pool.map(lambda i: countLines(data, targets[i], targets[i+1]), range(count))))
+                records = [-(-int(breaks[i]) // self.lines) for i in range(1, count)]
+                bounds = list(pool.map(lambda i: lineStart(data, targets[i+1], int(breaks[i+1]), records[i] * self.lines), range(count - 1)))
+                if self.pair is not None:
+                    psize = len(pdata)
+                    ptargets = [psize * i // count for i in range(count + 1)]
+                    pbreaks = np.cumsum([0] + list(pool.map(lambda i: countLines(pdata, ptargets[i], ptargets[i+1]), range(count))))
+                    if pbreaks[-1] != breaks[-1]:
+                        raise ValueError(f"Paired files have a different number of lines: {self.path}, {self.pair}")
+                    def pairStart(line):
+                        j = bisect.bisect_right(pbreaks, line, hi=count) - 1
+                        return lineStart(pdata, ptargets[j], int(pbreaks[j]), line)
+                    pbounds = list(pool.map(pairStart, [r * self.lines for r in records]))
+            # chunks that would be empty are merged into the next
+            spans = list()
+            start = 0
+            pstart = 0
+            for c, end in enumerate(bounds):
+                if end > start:
+                    spans.append(((start, end), (pstart, pbounds[c]) if self.pair is not None else None))
+                    start = end
+                    pstart = pbounds[c] if self.pair is not None else 0
+            if start < size or not spans:
+                spans.append(((start, size), (pstart, len(pdata)) if self.pair is not None else None))
+
+            jobs = list()
+            for i, (span, pspan) in enumerate(spans):
+                if self.virtual:
+                    self.files.append((self.path, *span))
+                    if self.pair is not None:
+                        self.pairs.append((self.pair, *pspan))
+                else:
+                    self.files.append(self.chunkName(self.path, i))
+                    jobs.append(pool.submit(writeRange, data, *span, self.files[-1]))
+                    if self.pair is not None:
+                        self.pairs.append(self.chunkName(self.pair, i))
+                        jobs.append(pool.submit(writeRange, pdata, *pspan, self.pairs[-1]))
+                self.costs.append(span[1] - span[0])
+            for job in jobs:
+                job.result()
+
+
+class MappedFile:
+    '''Read only memory map of a file, empty bytes for an empty file or None.'''
+    def __init__(self, path):
+        self.data = b''
+        if path is not None and os.path.getsize(path):
+            with open(path, 'rb') as reader:
+                self.data = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *args):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def nextRecord(data, pos, delim):
+    '''Offset of the first line starting with delim at or after pos.'''
+    if pos == 0 and data[:len(delim)] == delim:
+        return 0
+    pos = data.find(b'\n' + delim, max(pos - 1, 0))
+    return len(data) if pos < 0 else pos + 1
+
+
+def countLines(data, start, end):
+    '''Number of line breaks from byte start to end.'''
+    count = 0
+    for i in range(start, end, BLOCK):
+        count += int(np.count_nonzero(np.frombuffer(data, np.uint8, min(BLOCK, end - i), i) == 10))
+    return count
+
+
+def lineStart(data, pos, before, line):
+    '''Offset of the start of line number line, given the number of line breaks before pos (line >= before).'''
+    if line == before:
+        return data.rfind(b'\n', 0, pos) + 1
+    line -= before
+    while pos < len(data):
+        block = np.frombuffer(data, np.uint8, min(BLOCK, len(data) - pos), pos)
+        breaks = np.flatnonzero(block == 10)
+        if len(breaks) >= line:
+            return pos + int(breaks[line - 1]) + 1
+        line -= len(breaks)
+        pos += len(block)
+    return len(data)
+
+
+def writeRange(data, start, end, path):
+    '''Write bytes start to end of data to a file, compressed by its extension.'''
+    with cerberus_compress.openFile(path, 'wb') as writer, memoryview(data) as view:
+        for i in range(start, end, BLOCK):
+            writer.write(view[i:min(end, i + BLOCK)])
+    return path
 
 
 def human2bytes(s):
@@ -145,6 +360,12 @@ if __name__ == '__main__':
 
     # flags
     parser.add_argument('-c', '--chunksize', default='1000M', help='Approximate size of file chunks.')
+    parser.add_argument('--cost', default='size', choices=['size', 'residues'], help='Measure chunks in bytes of the file or in residues of the sequences.')
+    parser.add_argument('-n', '--chunks', type=int, help='Split into this number of chunks of equal cost, instead of by chunksize.')
+    parser.add_argument('--virtual', action='store_true', help='Only print the byte range of each chunk, without writing the chunks.')
+    parser.add_argument('-p', '--pair', help='Second file of paired reads, split in lockstep with infile (requires --lines).')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Split at byte offsets and write the chunks in parallel, with --cost size.')
+    parser.add_argument('-z', '--compress', action='store_true', help='Write the chunks compressed with gzip.')
 
     # required flag
     group = parser.add_mutually_exclusive_group(required=True)
@@ -153,4 +374,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    c = Chunker(args.infile, args.outfolder, chunksize=args.chunksize, delim=args.delimiter, lines=args.lines)
+    c = Chunker(args.infile, args.outfolder, chunksize=args.chunksize, delim=args.delimiter, lines=args.lines, cost=args.cost, chunks=args.chunks, virtual=args.virtual,
+                pair=args.pair, threads=args.threads, compress=args.compress)
+    if args.virtual:
+        for (path, start, end), cost in zip(c.files, c.costs):
+            print(path, start, end, cost, sep='\t')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""cerberus_cache.py: Module for caching HMMER hits between runs
+Hits are saved in an SQLite file by hash of the protein sequence and version
+of the HMM file, so later runs only search sequences missing from the cache.
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+from pathlib import Path
+import pyhmmer
+
+
+# Version of an HMM file, from databases.tsv when it was downloaded
+def hmmVersion(hmm:os.PathLike):
+    hmm = Path(hmm)
+    stat = hmm.stat()
+    version = None
+    db_tsv = Path(hmm.parent, "databases.tsv")
+    if db_tsv.exists():
+        with db_tsv.open() as reader:
+            reader.readline()
+            for line in reader:
+                line = line.split()
+                if len(line) == 4 and line[1] == hmm.name:
+                    version = line[3]
+    if version is None:
+        # not a downloaded database, use the modification time instead
+        version = stat.st_mtime_ns
+    return f"{hmm.name}:{stat.st_size}:{version}:pyhmmer-{pyhmmer.__version__}"
+
+
+class HitCache:
+    '''Hits of protein sequences against HMM files, saved in an SQLite file.
+
+    Each entry holds the hits of a sequence with a p-value up to pmax, so it can
+    be used by any search with E-value/Z <= pmax. Sequences without hits are saved
+    as empty entries. When the file grows over max_size bytes, the least recently
+    used entries are removed. The total size of the entries is kept in the
+    table total, updated with each change.
+
+    The default rollback journal is used, as WAL mode does not work on network
+    filesystems (NFS, Lustre) where a cache shared by the nodes of a cluster is kept.
+    '''
+    def __init__(self, path:os.PathLike, max_size:int=None):
+        self.max_size = max_size
+        self.db = sqlite3.connect(path, timeout=600)
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS hits (
+            seqhash TEXT, hmm TEXT, pmax REAL, hits BLOB, size INTEGER, atime REAL,
+            PRIMARY KEY (seqhash, hmm)) WITHOUT ROWID""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS hits_atime ON hits (atime)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS total (size INTEGER)")
+        if self.db.execute("SELECT COUNT(*) FROM total").fetchone()[0] == 0:
+            self.db.execute("INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM hits")
+        self.db.commit()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def get(self, hmm:str, hashes:list, pmax:float):
+        '''Cached hits of the sequences, for searches up to pmax.
+
+        Returns:
+            dict of {seqhash: [(query, pvalue, length, [(pvalue, score, start, end), ...]), ...]}
+        '''
+        found = dict()
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i+500]
+            rows = self.db.execute(f"SELECT seqhash, pmax, hits FROM hits WHERE hmm=? AND seqhash IN ({','.join('?'*len(batch))})", [hmm]+batch)
+            for seqhash,entry_pmax,hits in rows:
+                if pmax <= entry_pmax:
+                    found[seqhash] = pickle.loads(hits)
+        now = time.time()
+        self.db.executemany("UPDATE hits SET atime=? WHERE seqhash=? AND hmm=?", [(now, seqhash, hmm) for seqhash in found])
+        self.db.commit()
+        return found
+
+    def put(self, hmm:str, entries:dict, pmax:float):
+        '''Save the hits of sequences searched up to pmax, {seqhash: hits} as returned by get.'''
+        now = time.time()
+        rows = list()
+        for seqhash,hits in entries.items():
+            hits = pickle.dumps(hits, protocol=pickle.HIGHEST_PROTOCOL)
+            rows += [(seqhash, hmm, pmax, hits, len(seqhash)+len(hmm)+len(hits)+32, now)]
+        # lock before reading the sizes of the replaced entries, so the total stays exact
+        self.db.execute("BEGIN IMMEDIATE")
+        replaced = 0
+        hashes = list(entries)
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i+500]
+            replaced += self.db.execute(f"SELECT COALESCE(SUM(size), 0) FROM hits WHERE hmm=? AND seqhash IN ({','.join('?'*len(batch))})", [hmm]+batch).fetchone()[0]
+        self.db.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.db.execute("UPDATE total SET size = size + ?", (sum(row[4] for row in rows) - replaced,))
+        self.db.commit()
+        self.evict()
+        return
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is under 90% of max_size.'''
+        if not self.max_size:
+            return
+        if self.db.execute("SELECT size FROM total").fetchone()[0] <= self.max_size:
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        total = self.db.execute("SELECT size FROM total").fetchone()[0]
+        removed = 0
+        remove = list()
+        for seqhash,hmm,size in self.db.execute("SELECT seqhash, hmm, size FROM hits ORDER BY atime"):
+            if total - removed <= 0.9 * self.max_size:
+                break
+            remove += [(seqhash, hmm)]
+            removed += size
+        self.db.executemany("DELETE FROM hits WHERE seqhash=? AND hmm=?", remove)
+        self.db.execute("UPDATE total SET size = size - ?", (removed,))
+        self.db.commit()
+        return
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""cerberus_compress.py: Module for reading and writing compressed sequence files
+Files compressed with gzip (including bgzip) or zstd are recognized by extension.
+They are streamed through pigz or zstd when installed, for multi-threaded
+(de)compression in a separate process, or else the gzip and zstandard modules.
+"""
+
+import io
+import os
+import gzip
+import shutil
+import subprocess
+from pathlib import Path
+
+
+# Compression of files by extension
+SUFFIXES = {'.gz': 'gzip', '.bgz': 'gzip', '.zst': 'zstd'}
+
+# gzip level of intermediate files, favors speed
+LEVEL = 1
+
+
+# Compression of a file
+def compression(path:os.PathLike):
+    '''Compression of a file by its extension, 'gzip', 'zstd' or None.'''
+    return SUFFIXES.get(Path(path).suffix.lower())
+
+
+# Name and extension of a file, with the compression
+def splitExt(path:os.PathLike):
+    '''Split a file name into name and extension, keeping the compression in the extension.
+
+    i.e. reads_R1.fastq.gz -> ('reads_R1', '.fastq.gz')
+    '''
+    name, ext = os.path.splitext(os.path.basename(path))
+    if ext.lower() in SUFFIXES:
+        name, base = os.path.splitext(name)
+        ext = base + ext
+    return name, ext
+
+
+# Extension of an output file
+def outputExt(ext:str, compress:bool):
+    '''Extension with '.gz' appended if compress is set.'''
+    return ext + '.gz' if compress else ext
+
+
+# Command writing a decompressed file to stdout
+def catCommand(path:os.PathLike, threads:int=1):
+    '''Command line streaming the decompressed file to stdout, None if the file is not compressed.'''
+    path = str(path)
+    method = compression(path)
+    if method == 'gzip':
+        if shutil.which('pigz'):
+            return ['pigz', '-dc', '-p', str(threads), path]
+        return ['gzip', '-dc', path]
+    if method == 'zstd':
+        return ['zstd', '-dcq', path]
+    return None
+
+
+class PipeFile:
+    '''File object reading from (or writing to) a (de)compressing process.'''
+    def __init__(self, command:list, path:os.PathLike, mode:str):
+        self.path = Path(path)
+        if 'r' in mode:
+            self.output = None
+            self.proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+            self.file = self.proc.stdout
+        else:
+            self.output = open(path, 'wb')
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.output)
+            self.file = self.proc.stdin
+        if 'b' not in mode:
+            self.file = io.TextIOWrapper(self.file)
+        self.mode = mode
+
+    @property
+    def name(self):
+        '''Path of the file, not the descriptor of the pipe.'''
+        return str(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        code = self.proc.wait()
+        if self.output is not None:
+            self.output.close()
+        # a reader closed early stops the process with SIGPIPE
+        if code != 0 and not ('r' in self.mode and code == -13):
+            raise subprocess.CalledProcessError(code, self.proc.args)
+
+
+# Open a file, compressed or not
+def openFile(path:os.PathLike, mode:str='rt', threads:int=1):
+    '''Open a file for streaming, compressing or decompressing by its extension.
+
+    Supports modes 'r', 'w' and 'a', in text (default) or binary.
+    '''
+    method = compression(path)
+    if method is None:
+        return open(path, mode)
+    if 't' not in mode and 'b' not in mode:
+        mode += 't'
+    read = 'r' in mode
+    if method == 'gzip':
+        if shutil.which('pigz') and mode[0] != 'a':
+            if read:
+                return PipeFile(['pigz', '-dc', '-p', str(threads), str(path)], path, mode)
+            return PipeFile(['pigz', '-c', f'-{LEVEL}', '-p', str(threads)], path, mode)
+        return gzip.open(path, mode, compresslevel=LEVEL)
+    # zstd
+    try:
+        import zstandard
+        return zstandard.open(path, mode)
+    except ImportError:
+        if not shutil.which('zstd'):
+            raise RuntimeError(f"{path} requires the zstd command or the zstandard module")
+        if read:
+            return PipeFile(['zstd', '-dcq', str(path)], path, mode)
+        if mode[0] == 'a':
+            raise RuntimeError(f"Appending to {path} requires the zstandard module")
+        return PipeFile(['zstd', '-cq', f'-T{threads}'], path, mode)
+
+
+# Plain copy of a compressed file, for tools that cannot read it
+def plainFile(path:os.PathLike, outpath:os.PathLike, keep:tuple=('gzip',)):
+    '''Decompress a file into outpath, unless its compression is in keep.
+
+    Returns:
+        Path of the decompressed file, or path if it did not need decompressing.
+    '''
+    method = compression(path)
+    if method is None or method in keep:
+        return path
+    name, ext = splitExt(path)
+    plain = Path(outpath, name + Path(ext).stem)
+    Path(outpath).mkdir(parents=True, exist_ok=True)
+    with openFile(path, 'rb') as reader, plain.open('wb') as writer:
+        shutil.copyfileobj(reader, writer, 1 << 24)
+    return plain
@@ -6,6 +6,8 @@ Uses bbduk [https://sourceforge.net/projects/bbmap/]
 from pathlib import Path
 import subprocess
 
+from . import cerberus_compress
+
 
 # Decontaminate single end reads
 def deconSingleReads(key_value, config, subdir):
@@ -14,7 +16,8 @@ def deconSingleReads(key_value, config, subdir):
     key = key_value[0]
     value = key_value[1]
 
-    deconReads = path / f"decon-{key}.fastq"
+    # bbduk compresses the output by its extension
+    deconReads = path / f"decon-{key}{cerberus_compress.outputExt('.fastq', config.get('COMPRESS'))}"
     matched = path / f"matched_{key}"
     stats = path / "stats.txt"
 
@@ -25,6 +28,8 @@ def deconSingleReads(key_value, config, subdir):
     path.mkdir(exist_ok=True, parents=True)
 
     qc_seq = "ref="+config['QC_SEQ'] if config['QC_SEQ'] else ""
+    # zstd is not read by bbduk
+    value = cerberus_compress.plainFile(value, path)
 
     command = [config['EXE_BBDUK'], "-Xmx1g", f"in={value}", f"out={deconReads}", "qin=30", "qtrim=r", "minlen=50", "k=31", qc_seq, "hdist=1", f"stats={stats}"]
     try:
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""cerberus_faidx.py: Module for indexed access to the records of FASTA files
+Each FASTA file is indexed once. With a cache folder (the index folder of the output),
+the index (.fxi) and a decompressed copy of compressed files are saved there to be
+reused by later steps, otherwise they are kept in memory and a temporary file.
+Records are read from a memory map of the file, or of its decompressed copy.
+"""
+
+import os
+import mmap
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+
+from . import cerberus_compress
+
+
+# Index a FASTA file by name of the records
+def indexFasta(fasta:os.PathLike):
+    '''Read the records of a FASTA file into an index.
+
+    Returns:
+        dict of {name: (length, start, offset, end)}, in the order of the file.
+        length is the number of residues, start the offset of the header line,
+        offset the offset of the sequence and end the offset of the next record.
+        Offsets of compressed files are in the decompressed file.
+    '''
+    index = dict()
+    name = None
+    with cerberus_compress.openFile(fasta, 'rb') as reader:
+        pos = 0
+        for line in reader:
+            if line.startswith(b'>'):
+                if name is not None:
+                    index[name] = (length, start, offset, pos)
+                name = line[1:].rstrip().split(maxsplit=1)
+                name = name[0].decode() if name else ""
+                length = 0
+                start = pos
+                offset = pos + len(line)
+            elif name is not None:
+                length += len(line.strip())
+            pos += len(line)
+        if name is not None:
+            index[name] = (length, start, offset, pos)
+    return index
+
+
+class FastaIndex:
+    '''Random access to the records of a FASTA file.
+
+    If cache is given, the index is saved in the cache folder as <name>.<hash>.fxi,
+    a tsv of name, length, start, offset and end of each record, with the hash
+    of the path of the FASTA file. It is rebuilt if the FASTA file has been modified.
+    A compressed FASTA file is decompressed once into the cache folder, or into
+    a temporary file without a cache.
+    The input folders of the FASTA files are never written to.
+    '''
+    def __init__(self, fasta:os.PathLike, cache:os.PathLike=None):
+        self.path = Path(fasta)
+        stat = self.path.stat()
+        compressed = cerberus_compress.compression(self.path)
+        self.index = None
+        self.plain = None if compressed else self.path
+        idx = None
+        if cache:
+            name, ext = cerberus_compress.splitExt(self.path)
+            digest = hashlib.md5(str(self.path.resolve()).encode()).hexdigest()[:12]
+            idx = Path(cache, f"{name}.{digest}.fxi")
+            plain = Path(cache, f"{name}.{digest}{Path(ext).stem}") if compressed else self.path
+            try:
+                with idx.open() as reader:
+                    if reader.readline().split() == ['#', str(stat.st_mtime_ns), str(stat.st_size)] and plain.exists():
+                        self.index = dict()
+                        for line in reader:
+                            name,length,start,offset,end = line.rstrip('\n').split('\t')
+                            self.index[name] = (int(length), int(start), int(offset), int(end))
+                        self.plain = plain
+            except Exception:
+                self.index = None
+        if self.index is None and idx is not None:
+            # write to temporary files so other processes never read a partial copy or index
+            tmp = None
+            try:
+                idx.parent.mkdir(parents=True, exist_ok=True)
+                if compressed:
+                    # decompressed once, and indexed from the copy
+                    tmp = plain.with_name(f"{plain.name}.{os.getpid()}.tmp")
+                    with cerberus_compress.openFile(self.path, 'rb') as reader, tmp.open('wb') as writer:
+                        shutil.copyfileobj(reader, writer, 1 << 24)
+                    os.replace(tmp, plain)
+                    self.plain = plain
+                self.index = indexFasta(self.plain)
+                tmp = idx.with_name(f"{idx.name}.{os.getpid()}.tmp")
+                with tmp.open('w') as writer:
+                    print('#', stat.st_mtime_ns, stat.st_size, file=writer)
+                    for name,record in self.index.items():
+                        print(name, *record, sep='\t', file=writer)
+                os.replace(tmp, idx)
+            except OSError:
+                # cache is not writable, keep the index in memory only
+                if tmp is not None:
+                    tmp.unlink(missing_ok=True)
+        if self.index is None:
+            self.index = indexFasta(self.plain or self.path)
+
+        self.data = b''
+        if self.plain is None:
+            with tempfile.TemporaryFile() as plain:
+                with cerberus_compress.openFile(self.path, 'rb') as reader:
+                    shutil.copyfileobj(reader, plain, 1 << 24)
+                plain.flush()
+                if plain.tell():
+                    self.data = mmap.mmap(plain.fileno(), 0, access=mmap.ACCESS_READ)
+        elif self.plain.stat().st_size:
+            with self.plain.open('rb') as reader:
+                self.data = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b''
+
+    def between(self, start:int=0, end:int=None):
+        '''Names of the records starting from byte start up to byte end of the file.'''
+        if start == 0 and end is None:
+            return list(self.index)
+        if end is None:
+            end = len(self.data)
+        return [name for name,record in self.index.items() if start <= record[1] < end]
+
+    def length(self, name:str):
+        return self.index[name][0]
+
+    def record(self, name:str):
+        '''Bytes of the record, header line and sequence lines, without copying.'''
+        length,start,offset,end = self.index[name]
+        return memoryview(self.data)[start:end]
+
+    def lines(self, name:str):
+        '''Bytes of the sequence lines of the record, without copying.'''
+        length,start,offset,end = self.index[name]
+        return memoryview(self.data)[offset:end]
+
+    def header(self, name:str):
+        '''Header line of the record, without the leading '>'.'''
+        length,start,offset,end = self.index[name]
+        return self.data[start+1:offset].rstrip().decode()
+
+    def sequence(self, name:str, binary:bool=False):
+        '''Sequence of the record as a str (or bytes if binary), with the line breaks removed.'''
+        length,start,offset,end = self.index[name]
+        sequence = b''.join(self.data[offset:end].split())
+        return sequence if binary else sequence.decode()
+
+    def first(self):
+        '''Offset of the first record in the file.'''
+        if not self.index:
+            return len(self.data)
+        return min(start for length,start,offset,end in self.index.values())
@@ -9,13 +9,16 @@ import re
 import subprocess
 import textwrap
 
+from . import cerberus_compress
+
 
 # Remove quality from fastq
 def reformat(fastq:Path, config:dict, subdir:Path):
     path = Path(config['DIR_OUT'], subdir)
     fastq = Path(fastq)
 
-    fasta = Path(path, fastq.name).with_suffix(".fna")
+    name, ext = cerberus_compress.splitExt(fastq)
+    fasta = Path(path, name + cerberus_compress.outputExt(".fna", config.get('COMPRESS')))
 
     done = Path(path, 'complete')
     if not config['REPLACE'] and done.exists() and fasta.exists():
@@ -23,10 +26,17 @@ def reformat(fastq:Path, config:dict, subdir:Path):
     done.unlink(missing_ok=True)
     path.mkdir(exist_ok=True, parents=True)
 
-    command = ["sed", "-n", '1~4s/^@/>/p;2~4p', fastq.as_posix()]
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
-
-    with fasta.open('w') as writer:
+    command = ["sed", "-n", '1~4s/^@/>/p;2~4p']
+    cat = cerberus_compress.catCommand(fastq, config.get('CPUS', 1))
+    if cat:
+        # stream the decompressed reads into sed
+        p_cat = subprocess.Popen(cat, stdout=subprocess.PIPE)
+        p = subprocess.Popen(command, stdin=p_cat.stdout, stdout=subprocess.PIPE, text=True)
+        p_cat.stdout.close()
+    else:
+        p = subprocess.Popen(command + [fastq.as_posix()], stdout=subprocess.PIPE, text=True)
+
+    with cerberus_compress.openFile(fasta, 'wt') as writer:
         headers = set()
         for line in p.stdout:
             if line.startswith(">"):
@@ -37,6 +47,9 @@ def reformat(fastq:Path, config:dict, subdir:Path):
                 writer.write(f"{line[0]} {line[1]}")
             else:
                 writer.write(line)
+    p.wait()
+    if cat and p_cat.wait() != 0:
+        raise subprocess.CalledProcessError(p_cat.returncode, cat)
 
     done.touch()
     return fasta
@@ -65,9 +78,10 @@ def split_sequenceN(name, sequence):
 def removeN(fasta:str, config:dict, subdir:os.PathLike):
     path = Path(config['DIR_OUT'], subdir)
 
-    outFasta, ext = os.path.splitext(fasta)
-    outFasta = os.path.basename(outFasta) + "_clean"+ ext
-    outFasta = Path(path, outFasta)
+    outFasta, ext = cerberus_compress.splitExt(fasta)
+    if cerberus_compress.compression(fasta):
+        ext = Path(ext).stem
+    outFasta = Path(path, outFasta + "_clean" + cerberus_compress.outputExt(ext, config.get('COMPRESS')))
 
     done = Path(path, 'complete')
     if not config['REPLACE'] and done.exists() and outFasta.exists():
@@ -75,13 +89,20 @@ def removeN(fasta:str, config:dict, subdir:os.PathLike):
     done.unlink(missing_ok=True)
     path.mkdir(exist_ok=True, parents=True)
 
-    proc = subprocess.run(['grep', '-cE', '^[^>].*N', fasta], stdout=subprocess.PIPE, text=True)
+    cat = cerberus_compress.catCommand(fasta, config.get('CPUS', 1))
+    if cat:
+        p_cat = subprocess.Popen(cat, stdout=subprocess.PIPE)
+        proc = subprocess.run(['grep', '-cE', '^[^>].*N'], stdin=p_cat.stdout, stdout=subprocess.PIPE, text=True)
+        p_cat.stdout.close()
+        p_cat.wait()
+    else:
+        proc = subprocess.run(['grep', '-cE', '^[^>].*N', fasta], stdout=subprocess.PIPE, text=True)
     res = int(proc.stdout.strip())
     if res == 0:
         done.touch()
         return fasta, None
 
-    with open(fasta) as reader, outFasta.open('w') as writer:
+    with cerberus_compress.openFile(fasta) as reader, cerberus_compress.openFile(outFasta, 'wt') as writer:
         NStats = dict()
         line = reader.readline()
         while line:
@@ -6,11 +6,40 @@ Uses FGS+
 Uses Phanotate
 """
 
+import io
+import os
 import re
+import shlex
+import hashlib
+import tempfile
+import contextlib
 from pathlib import Path
 import subprocess
+import heapq
+import collections
+import concurrent.futures
 import pyrodigal
 import pyrodigal_gv
+import pyhmmer
+
+from . import cerberus_compress
+from . import cerberus_faidx
+from . import cerberus_hmm
+
+
+# Output formats of gene calling, and the method of pyrodigal Genes writing each
+GENECALL_OUTPUTS = {'faa': 'write_translations', 'fna': 'write_genes', 'gff': 'write_gff', 'gbk': 'write_genbank'}
+# Formats always written, read by the later steps and the final GFF and GenBank files of the report
+GENECALL_REQUIRED = ('faa', 'gff')
+
+# Gene IDs in the outputs of pyrodigal, ID=<contig number>_<gene number>
+RE_GENE_ID = re.compile(r'(?<=[\t "])ID=\d+_')
+
+# Largest contigs submitted first, per thread
+LARGEST_FIRST = 2
+
+# Bases used to train single genome mode, the maximum length of a sequence in Prodigal
+TRAIN_MAX = 32000000
 
 
 # Eukaryotic option
@@ -33,6 +62,10 @@ def findORF_fgs(contig, config, subdir):
          train = "454_30"
 
     command = f"{config['EXE_FGS']} -p {config['CPUS']} -s {contig} -o {baseOut} -w 1 -t {train}"
+    cat = cerberus_compress.catCommand(contig, config['CPUS'])
+    if cat:
+        # FragGeneScanRS reads the decompressed sequences from stdin
+        command = f"{shlex.join(cat)} | {config['EXE_FGS']} -p {config['CPUS']} -o {baseOut} -w 1 -t {train}"
     try:
         with Path(path,"stdout.txt").open('w') as fout, Path(path,"stderr.txt").open('w') as ferr:
             subprocess.run(command, shell=True, check=True, stdout=fout, stderr=ferr)
@@ -44,50 +77,269 @@ def findORF_fgs(contig, config, subdir):
     return faaOut
 
 
-# Microbial option
-def findORF_prod(contig, config, subdir, meta=False, viral=False):
-    path = Path(config['DIR_OUT'], subdir)
-    path.mkdir(exist_ok=True, parents=True)
-    done = path / "complete"
+# Read the contigs of a FASTA file
+def readContigs(reader):
+    '''Yields the ID and sequence of each record, from a text reader.'''
+    line = reader.readline()
+    while line:
+        if line.startswith(">"):
+            seq_id = line[1:].split()[0]
+            seq = list()
+            line = reader.readline()
+            while line:
+                if line.startswith(">"):
+                    break
+                seq += [line.strip()]
+                line = reader.readline()
+            yield seq_id, "".join(seq)
+            continue
+        line = reader.readline()
 
-    faa = path / "proteins.faa"
-    fna = faa.with_suffix(".fna")
-    gff = faa.with_suffix(".gff")
-    gbk = faa.with_suffix(".gbk")
 
-    if not config['REPLACE'] and done.exists() and faa.exists():
-        return faa
-    done.unlink(missing_ok=True)
+# Training info of a genome for single mode
+def trainFinder(contig, cache:os.PathLike, max_bases:int=TRAIN_MAX):
+    '''Train pyrodigal on the contigs, streamed until max_bases, like Prodigal joined with linkers.
+
+    The training info is saved in the cache folder by checksum of the training sequences,
+    and reused by runs training on the same sequences.
+
+    Returns:
+        pyrodigal.TrainingInfo
+    '''
+    seqs = list()
+    total = 0
+    checksum = hashlib.sha256(f"pyrodigal-{pyrodigal.__version__}".encode())
+    with cerberus_compress.openFile(contig, 'rt') as reader:
+        for _, seq in readContigs(reader):
+            seq = seq[:max_bases-total]
+            checksum.update(b">" + seq.encode())
+            seqs.append(seq)
+            total += len(seq)
+            if total >= max_bases:
+                break
+    if not seqs:
+        raise ValueError(f"No sequences to train on in {contig}")
+
+    cache = Path(cache)
+    trn = cache / f"{checksum.hexdigest()}.trn"
+    if trn.exists():
+        with trn.open('rb') as reader:
+            return pyrodigal.TrainingInfo.load(reader)
+    train = pyrodigal.GeneFinder(meta=False).train(*seqs)
+    # write to a temporary file first, other tasks may read the cache
+    cache.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=cache, suffix=".tmp", delete=False) as writer:
+        train.dump(writer)
+    os.replace(writer.name, trn)
+    return train
+
+
+# Genes of each contig with pyrodigal
+def callGenes(contig, config, path:Path, meta=False, viral=False, threads=1, stats:dict=None):
+    '''Yields the ID, pyrodigal Genes and number of each contig, in the order of the contigs.
 
+    With threads > 1, the contigs are searched in a pool of threads sharing
+    the gene finder, and the largest contigs are submitted first so they do
+    not finish last. The genes are then numbered by the order threads started
+    them, and the number of the contig is yielded to renumber them (see writeGenes),
+    otherwise the number is None. Training info of single mode is cached in
+    config['TRAINING_CACHE'], or else in path.
+    Contigs shorter than config['MIN_CONTIG_LENGTH'] are skipped, and counted in stats if given.
+    '''
     if viral:
         orf_finder = pyrodigal_gv.ViralGeneFinder(meta=True, viral_only=True)
     elif not meta:
-        train = pyrodigal.GeneFinder(meta=False).train(open(contig).read())
+        train = trainFinder(contig, config.get('TRAINING_CACHE') or path)
         orf_finder = pyrodigal.GeneFinder(training_info=train, meta=meta)
     else:
         orf_finder = pyrodigal.GeneFinder(meta=True)
-    with open(contig, 'rt') as reader, open(faa, 'wt') as w_faa, open(fna, 'wt') as w_fna, open(gff, 'wt') as w_gff, open(gbk, 'wt') as w_gbk:
-        line = reader.readline()
-        while line:
-            if line.startswith(">"):
-                seq_id = line[1:].split()[0]
-                seq = list()
-                line = reader.readline()
-                while line:
-                    if line.startswith(">"):
-                        break
-                    seq += [line.strip()]
-                    line = reader.readline()
-                genes = orf_finder.find_genes("".join(seq))
-                genes.write_translations(w_faa, seq_id)
-                genes.write_genes(w_fna, seq_id)
-                genes.write_gff(w_gff, seq_id)
-                genes.write_genbank(w_gbk, seq_id)
-                continue
-            line = reader.readline()
 
-    done.touch()
-    return faa
+    min_length = config.get('MIN_CONTIG_LENGTH') or 0
+    if stats is None:
+        stats = dict()
+    stats.update(contigs=0, bases=0)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        largest = dict()
+        if threads > 1:
+            with cerberus_faidx.FastaIndex(contig, config.get('DIR_INDEX')) as fasta_index:
+                names = [name for name in fasta_index if fasta_index.length(name) >= min_length]
+                for name in heapq.nlargest(LARGEST_FIRST * threads, names, key=fasta_index.length):
+                    seq = fasta_index.sequence(name)
+                    largest[name] = (seq, executor.submit(orf_finder.find_genes, seq))
+        with cerberus_compress.openFile(contig, 'rt') as reader:
+            # find_genes releases the GIL, contigs in progress are limited to a few per thread
+            pending = collections.deque()
+            seqnum = 0
+            for seq_id, seq in readContigs(reader):
+                if len(seq) < min_length:
+                    stats['contigs'] += 1
+                    stats['bases'] += len(seq)
+                    continue
+                seqnum += 1
+                if threads > 1:
+                    # the sequence is compared as names may not be unique
+                    if seq_id in largest and largest[seq_id][0] == seq:
+                        job = largest.pop(seq_id)[1]
+                    else:
+                        job = executor.submit(orf_finder.find_genes, seq)
+                    pending.append((seq_id, seqnum, job))
+                    if len(pending) >= 4 * threads:
+                        seq_id, seqnum_done, job = pending.popleft()
+                        yield seq_id, job.result(), seqnum_done
+                else:
+                    yield seq_id, orf_finder.find_genes(seq), None
+            while pending:
+                seq_id, seqnum_done, job = pending.popleft()
+                yield seq_id, job.result(), seqnum_done
+
+
+# Output files of gene calling
+def genecallFiles(path:Path, config:dict):
+    '''Output files selected in config['GENECALL_OUTPUTS'], {ext: path}. The FAA and GFF files are always written.'''
+    outputs = config.get('GENECALL_OUTPUTS') or GENECALL_OUTPUTS
+    return {ext: path / f"proteins.{ext}" for ext in GENECALL_OUTPUTS if ext in GENECALL_REQUIRED or ext in outputs}
+
+
+# Write the genes of a contig
+def writeGenes(writers:dict, seq_id:str, genes, seqnum:int=None):
+    '''Write the genes to the writers of each output format, {ext: writer}.
+
+    If seqnum is given, the gene IDs (ID=<contig number>_<gene number>) are renumbered for the contig seqnum.
+    '''
+    for ext, writer in writers.items():
+        if seqnum is None:
+            getattr(genes, GENECALL_OUTPUTS[ext])(writer, seq_id)
+        else:
+            output = io.StringIO()
+            getattr(genes, GENECALL_OUTPUTS[ext])(output, seq_id)
+            writer.write(RE_GENE_ID.sub(f"ID={seqnum}_", output.getvalue()))
+    return
+
+
+# Call genes and write the output files
+def writeOutputs(contig, config, path:Path, files:dict, meta=False, viral=False, threads=1, proteins=None):
+    '''Call the genes of the contigs and write them to the output files, {ext: path}.
+
+    If proteins (a DigitalSequenceBlock) is given, the translations are appended
+    to it as the genes are called, while the files are written by a background thread.
+    '''
+    alphabet = pyhmmer.easel.Alphabet.amino()
+    stats = dict()
+    with contextlib.ExitStack() as stack:
+        writers = {ext: stack.enter_context(open(outfile, 'wt')) for ext, outfile in files.items()}
+        if proteins is None:
+            for seq_id, genes, seqnum in callGenes(contig, config, path, meta, viral, threads, stats):
+                writeGenes(writers, seq_id, genes, seqnum)
+        else:
+            writer = stack.enter_context(concurrent.futures.ThreadPoolExecutor(1))
+            jobs = collections.deque()
+            for seq_id, genes, seqnum in callGenes(contig, config, path, meta, viral, threads, stats):
+                jobs.append(writer.submit(writeGenes, writers, seq_id, genes, seqnum))
+                for i, gene in enumerate(genes, 1):
+                    # same names and translations as in the FAA file
+                    proteins.append(pyhmmer.easel.TextSequence(name=f"{seq_id}_{i}".encode(), sequence=gene.translate()).digitize(alphabet))
+                while jobs and jobs[0].done():
+                    jobs.popleft().result()
+            for job in jobs:
+                job.result()
+    writeShortContigs(config, path, stats)
+    return
+
+
+# Stats of the contigs skipped by gene calling
+def writeShortContigs(config, path:Path, stats:dict):
+    '''Write the number and bases of contigs shorter than config['MIN_CONTIG_LENGTH'], read by cerberus_report.write_Stats.'''
+    outfile = Path(path, "short_contigs.tsv")
+    min_length = config.get('MIN_CONTIG_LENGTH') or 0
+    if not min_length:
+        outfile.unlink(missing_ok=True)
+        return
+    with outfile.open('w') as writer:
+        print("min_length", "contigs", "bases", sep='\t', file=writer)
+        print(min_length, stats['contigs'], stats['bases'], sep='\t', file=writer)
+    return
+
+
+# Output files of an earlier run
+def reuseOutputs(contig, config, path:Path, meta=False, viral=False, threads=1):
+    '''True if the genes were called by an earlier run, which is reused unless config['REPLACE'] is set.
+
+    Formats selected since then are regenerated, calling the genes again with
+    the same finder (and cached training info), and other files are kept.
+    Otherwise, outputs of formats not selected are removed.
+    '''
+    done = path / "complete"
+    files = genecallFiles(path, config)
+    if not config['REPLACE'] and done.exists() and files['faa'].exists():
+        missing = {ext: outfile for ext, outfile in files.items() if not outfile.exists()}
+        if missing:
+            writeOutputs(contig, config, path, missing, meta, viral, threads)
+        return True
+    done.unlink(missing_ok=True)
+    for ext in GENECALL_OUTPUTS:
+        if ext not in files:
+            Path(path, f"proteins.{ext}").unlink(missing_ok=True)
+    return False
+
+
+# Microbial option
+def findORF_prod(contig, config, subdir, meta=False, viral=False, threads=1):
+    '''Find genes with pyrodigal (or pyrodigal-gv if viral).
+
+    With threads > 1, the contigs are searched in a pool of threads sharing
+    the gene finder, and the genes are written in the order of the contigs.
+    Training info of single mode is cached in config['TRAINING_CACHE'], or else in the output folder.
+    Only the formats of config['GENECALL_OUTPUTS'] are written, see genecallFiles.
+    '''
+    path = Path(config['DIR_OUT'], subdir)
+    path.mkdir(exist_ok=True, parents=True)
+    files = genecallFiles(path, config)
+
+    if reuseOutputs(contig, config, path, meta, viral, threads):
+        return files['faa']
+
+    writeOutputs(contig, config, path, files, meta, viral, threads)
+
+    Path(path, "complete").touch()
+    return files['faa']
+
+
+# Microbial option, searching the proteins without reading them back from the FAA file
+def searchORF_prod(contig, config, subdir, meta=False, viral=False, threads=1, hmmSubdir=None, hmmSearch:dict=None, hmmViews:dict=None):
+    '''Find genes with pyrodigal and search their proteins with the HMM files in the same task.
+
+    The translations are digitized as the genes are called, while the output
+    files are written by a background thread. The proteins are then searched
+    with each HMM file of hmmSearch ({hmmKey: hmm path}), filtered for the
+    views of hmmViews ({hmmKey: {dbname: dbpath}}), see cerberus_hmm.searchHMM.
+
+    Returns:
+        (faa, {hmmKey: {dbname: filtered hits file}})
+    '''
+    path = Path(config['DIR_OUT'], subdir)
+    path.mkdir(exist_ok=True, parents=True)
+    files = genecallFiles(path, config)
+    faa = files['faa']
+
+    key = path.name
+    if reuseOutputs(contig, config, path, meta, viral, threads):
+        proteins = cerberus_hmm.readSequences(faa) if faa.stat().st_size else None
+    else:
+        proteins = pyhmmer.easel.DigitalSequenceBlock(pyhmmer.easel.Alphabet.amino())
+        writeOutputs(contig, config, path, files, meta, viral, threads, proteins)
+        Path(path, "complete").touch()
+
+    searched = dict()
+    if not proteins:
+        return faa, searched
+    if config.get('HIT_CACHE'):
+        # the hit cache reads the sequences from the FAA file
+        proteins = faa
+    for hmm in hmmSearch.items():
+        views = hmmViews[hmm[0]]
+        searched[hmm[0]] = cerberus_hmm.searchHMM({key: proteins}, config, hmmSubdir, hmm, threads, views)[0]
+    return faa, searched
 
 
 # Phage
@@ -108,6 +360,7 @@ def findORF_phanotate(contig, config, subdir, meta=False):
     ferr = Path(path, "stderr.txt").open('w')
 
     # Phanotate > genbank file
+    contig = cerberus_compress.plainFile(contig, path, keep=())
     command = [config['EXE_PHANOTATE'], '-f', 'genbank', contig]
     try:
         with gbk.open('w') as fout:
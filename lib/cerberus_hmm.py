@@ -4,16 +4,112 @@
 Uses HMMER hmmsearch
 """
 
+import io
 import os
-import re
+import mmap
+import bisect
+import hashlib
+import contextlib
+from collections import OrderedDict
 from pathlib import Path
 import pyhmmer
 
+from . import cerberus_cache
+from . import cerberus_faidx
+from . import cerberus_lookup
+
+
+# Profiles loaded by this process, reused across calls to searchHMM
+# {hmm path: (mtime, [OptimizedProfile])}, least recently used first
+HMM_CACHE = OrderedDict()
+# HMM files kept loaded per process, profiles of KOFam take GBs of memory
+HMM_CACHE_MAX = 2
+
+
+## Load HMM profiles
+def loadHMM(hmm:os.PathLike):
+    '''Load and optimize the profiles in an HMM file, once per worker process.
+
+    The profiles are kept in memory and served to every search in the same
+    worker. The cache is keyed by the HMM file path and is reloaded if the
+    file has been modified. Only the HMM_CACHE_MAX most recently used files
+    are kept, the others are dropped before loading a new file.
+    '''
+    hmm = Path(hmm).resolve()
+    mtime = hmm.stat().st_mtime_ns
+    if hmm in HMM_CACHE:
+        if HMM_CACHE[hmm][0] == mtime:
+            HMM_CACHE.move_to_end(hmm)
+            return HMM_CACHE[hmm][1]
+        del HMM_CACHE[hmm]
+    while len(HMM_CACHE) >= HMM_CACHE_MAX:
+        HMM_CACHE.popitem(last=False)
+
+    profiles = list()
+    with pyhmmer.plan7.HMMFile(hmm) as hmm_reader:
+        background = None
+        for model in hmm_reader:
+            if background is None:
+                background = pyhmmer.plan7.Background(model.alphabet)
+            profile = pyhmmer.plan7.Profile(model.M, model.alphabet)
+            profile.configure(model, background)
+            profiles.append(profile.to_optimized())
+    HMM_CACHE[hmm] = (mtime, profiles)
+    return profiles
+
+
+## Amino acid file of a search
+def chunkRange(amino):
+    '''Path and byte range of an amino acid file, or of a virtual chunk (path, start, end).
+
+    Returns:
+        (path, start, end), end is None for the whole file.
+    '''
+    if isinstance(amino, (tuple, list)):
+        return Path(amino[0]), amino[1], amino[2]
+    return Path(amino), 0, None
+
+
+## Read the sequences of an amino acid file
+def readSequences(amino):
+    '''Digital sequences of an amino acid file, or of a virtual chunk read from a memory map of the file.
+
+    A DigitalSequenceBlock already in memory is returned as is.
+    '''
+    if isinstance(amino, pyhmmer.easel.DigitalSequenceBlock):
+        return amino
+    path,start,end = chunkRange(amino)
+    if end is None:
+        with pyhmmer.easel.SequenceFile(path, digital=True) as seq_reader:
+            return seq_reader.read_block()
+    with path.open('rb') as reader, mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        with pyhmmer.easel.SequenceFile(io.BytesIO(data[start:end]), format='fasta', digital=True, alphabet=pyhmmer.easel.Alphabet.amino()) as seq_reader:
+            return seq_reader.read_block()
+
 
 ## HMMER Search
-def searchHMM(aminoAcids:dict, config:dict, subdir:str, hmm:tuple, CPUs:int=4):
+def searchHMM(aminoAcids:dict, config:dict, subdir:str, hmm:tuple, CPUs:int=4, views:dict=None, Z:int=None):
+    '''Search amino acid files with an HMM file.
+
+    If views is given ({dbname: dbpath}), the hits are filtered in-process for
+    each database view and only the filtered hits are written, as
+    filtered-{dbname}.tsv. The unfiltered hits are only written if
+    config['KEEP_HMMER_RAW'] is set.
+
+    Returns:
+        A list with, per amino acid file, the raw hits file, or a dict of
+        {dbname: filtered hits file} if views is given.
+
+    An amino acid file can also be a virtual chunk (path, start, end), to
+    search only the records in that byte range of the file, or a
+    DigitalSequenceBlock of proteins already in memory.
+
+    If Z is given, E-values are computed for Z sequences instead of the number of sequences searched.
+    If config['HIT_CACHE'] is set, only the sequences missing from the hit cache are searched.
+    '''
     minscore = config['MINSCORE']
     evalue = config['EVALUE']
+    keep_raw = views is None or config.get('KEEP_HMMER_RAW', False)
 
     hmmKey,hmm = hmm
 
@@ -33,38 +129,125 @@ def searchHMM(aminoAcids:dict, config:dict, subdir:str, hmm:tuple, CPUs:int=4):
         outfile = os.path.join(pathname, f"{hmmKey}-{outname}")
 
         # HMMER
-        errfile=Path(outfile).with_suffix('.err').open('w')
-        with open(outfile, 'wt') as hmm_writer, pyhmmer.plan7.HMMFile(hmm) as hmm_reader, pyhmmer.easel.SequenceFile(amino, digital=True) as seq_reader:
-            for hit in pyhmmer.hmmer.hmmsearch(hmm_reader, seq_reader, E=evalue, cpus=CPUs):
-                for h in hit:
-                    for domain in h.domains.included:
-                        if domain.score < minscore:
-                            continue
-                        align = domain.alignment
-                        print(h.name.decode(), hit.query_name.decode(), f'{h.evalue:.1E}', f"{domain.score:.1f}", h.length,
-                            align.target_from, align.target_to,
-                            sep='\t', file=hmm_writer)
-        outlist += [outfile]
-        errfile.close
+        with Path(outfile).with_suffix('.err').open('w') as errfile:
+            profiles = loadHMM(hmm)
+            if config.get('HIT_CACHE'):
+                hits = searchCached(profiles, amino, config, hmm, CPUs, Z)
+            else:
+                hits = searchHits(profiles, amino, minscore, evalue, CPUs, Z)
+            # hits are streamed to the raw hits file and to the hits of each view, never held in a single list
+            lookups = dict()
+            for dbname,dbpath in (views or dict()).items():
+                lookups[dbname] = cerberus_lookup.loadLookup(dbpath, dbname)['rows']
+            with (open(outfile, 'wt') if keep_raw else contextlib.nullcontext()) as hmm_writer:
+                BH_views = filterViews(hits, lookups, hmm_writer)
+
+        if views is None:
+            outlist += [outfile]
+            continue
+        filtered = dict()
+        for dbname in views:
+            filtered[dbname] = Path(pathname, f"filtered-{dbname}.tsv")
+            writeFiltered(BH_views.pop(dbname), filtered[dbname])
+        outlist += [filtered]
 
     return outlist
 
 
-# Filter HMM results
-def filterHMM(hmm_tsv:Path, outfile:Path, dbpath:Path):
-    outfile.parent.mkdir(parents=True, exist_ok=True)
+## HMMER Search
+def searchHits(profiles:list, amino, minscore:float, evalue:float, CPUs:int=4, Z:int=None):
+    '''Yields (target, query, e_value, score, length, start, end) for each included domain, as found by hmmsearch.'''
+    options = dict(Z=Z) if Z else dict()
+    for hit in pyhmmer.hmmer.hmmsearch(profiles, readSequences(amino), E=evalue, cpus=CPUs, **options):
+        query = hit.query_name.decode()
+        for h in hit:
+            for domain in h.domains.included:
+                if domain.score < minscore:
+                    continue
+                align = domain.alignment
+                # values are rounded as written to the raw hits file
+                yield (h.name.decode(), query, float(f'{h.evalue:.1E}'), float(f"{domain.score:.1f}"), h.length,
+                    align.target_from, align.target_to)
 
-    for i in range(1, len(dbpath.suffixes)):
-        dbpath = Path(dbpath.with_suffix(''))
-    dbLookup = dbpath.with_suffix('.tsv')
-    match = re.search(r"^KOFam_[a-z]+_([A-Z]+)", hmm_tsv.name)
-    if match:
-        dbLookup = dbpath.with_name(f'{match.group(1)}.tsv')
-    dbLookup = dbLookup.read_text()
 
-    BH_target = dict()
-    logfile = outfile.with_suffix('.log')
-    with hmm_tsv.open() as reader, logfile.open('w') as logger:
+# Inclusion thresholds of hmmsearch
+INC_E = 0.01
+INC_DOM_E = 0.01
+
+
+## HMMER Search with cached hits
+def searchCached(profiles:list, amino, config:dict, hmm:os.PathLike, CPUs:int=4, Z:int=None):
+    '''Search an amino acid file, only searching the sequences missing from the hit cache.
+
+    The hits of each sequence are cached with their p-values, and thresholded
+    as hmmsearch would for the whole file: E-values for Z sequences (the number
+    of sequences in the file if not given), and domains included for the number
+    of hits reported by each HMM.
+
+    Yields:
+        hits (target, query, e_value, score, length, start, end)
+    '''
+    minscore = config['MINSCORE']
+    evalue = config['EVALUE']
+    version = cerberus_cache.hmmVersion(hmm)
+    max_size = config.get('HIT_CACHE_SIZE', 0) * 1024**2
+
+    # Hash of each sequence, and search of the distinct sequences missing from the cache
+    alphabet = pyhmmer.easel.Alphabet.amino()
+    path,start,end = chunkRange(amino)
+    with cerberus_faidx.FastaIndex(path, config.get('DIR_INDEX')) as faa_index, cerberus_cache.HitCache(config['HIT_CACHE'], max_size) as cache:
+        targets = [(name, hashlib.md5(faa_index.sequence(name, binary=True)).hexdigest()) for name in faa_index.between(start, end)]
+        if not Z:
+            Z = len(targets)
+        pmax = evalue / max(Z, 1)
+        cached = cache.get(version, {seqhash for name,seqhash in targets}, pmax)
+        missing = dict()
+        for name,seqhash in targets:
+            if seqhash not in cached and seqhash not in missing:
+                missing[seqhash] = pyhmmer.easel.TextSequence(name=seqhash.encode(), sequence=faa_index.sequence(name)).digitize(alphabet)
+        if missing:
+            searched = {seqhash:list() for seqhash in missing}
+            block = pyhmmer.easel.DigitalSequenceBlock(alphabet, missing.values())
+            for hit in pyhmmer.hmmer.hmmsearch(profiles, block, E=evalue, Z=Z, cpus=CPUs):
+                query = hit.query_name.decode()
+                for h in hit:
+                    if h.pvalue * Z > evalue:
+                        continue
+                    domains = [(d.pvalue, d.score, d.alignment.target_from, d.alignment.target_to) for d in h.domains]
+                    searched[h.name.decode()] += [(query, h.pvalue, h.length, domains)]
+            cache.put(version, searched, pmax)
+            cached.update(searched)
+            del missing, block
+
+    # Number of hits reported for each HMM, the search space of domains (domZ)
+    reported = dict()
+    for name,seqhash in targets:
+        for query,pvalue,length,domains in cached[seqhash]:
+            if pvalue * Z <= evalue:
+                reported[query] = reported.get(query, 0) + 1
+    # hits in the order of hmmsearch, by HMM then by p-value of the hit
+    included = {profile.name.decode():list() for profile in profiles}
+    for i,(name,seqhash) in enumerate(targets):
+        for query,pvalue,length,domains in cached[seqhash]:
+            e_value = pvalue * Z
+            if e_value <= evalue and e_value <= INC_E:
+                included[query] += [(pvalue, i, name, length, domains)]
+    for query,query_hits in included.items():
+        for pvalue,i,name,length,domains in sorted(query_hits, key=lambda x: x[:2]):
+            for dom_pvalue,score,start,end in domains:
+                if dom_pvalue * reported[query] > INC_DOM_E or score < minscore:
+                    continue
+                # values are rounded as written to the raw hits file
+                yield (name, query, float(f'{pvalue*Z:.1E}'), float(f"{score:.1f}"), length, start, end)
+    return
+
+
+# Read hits from an HMMER tsv file
+def readHits(hmm_tsv:Path, logger=None):
+    '''Yields (target, query, e_value, score, length, start, end) for each hit in hmm_tsv.
+    Lines that fail to parse (i.e. headers) are skipped and reported to logger.
+    '''
+    with Path(hmm_tsv).open() as reader:
         for i,line in enumerate(reader, 1):
             line = line.split('\t')
             try:
@@ -76,48 +259,165 @@ def filterHMM(hmm_tsv:Path, outfile:Path, dbpath:Path):
                 start = int(line[5])
                 end = int(line[6])
             except:
-                print("Failed to read line:", i, hmm_tsv, file=logger)
+                if logger:
+                    print("Failed to read line:", i, hmm_tsv, file=logger)
                 continue
+            yield target, query, e_value, score, length, start, end
+
+
+# Kept hits of a target compared to a new hit without searching the sorted starts
+SWEEP_MIN = 8
+
+
+# Resolve overlapping hits
+def filterHits(hits, dbLookup):
+    '''Keep the best hits per target, resolving overlapping domains.
+
+    Hits can be streamed from a search or read from a file (see readHits).
+
+    Parameters:
+        hits: iterable of (target, query, e_value, score, length, start, end)
+        dbLookup: IDs in the lookup table (see cerberus_lookup), hits with a query not in it are dropped
+
+    Returns:
+        dict of {target: [(query, e_value, score, length, start, end)]}, sorted by start
+    '''
+    return filterViews(hits, {None: dbLookup})[None]
+
+
+def filterViews(hits, lookups:dict, writer=None):
+    '''Keep the best hits per target for several database views, in a single pass over the hits.
+
+    Each hit is resolved against the hits kept so far for its target as it
+    arrives (see resolveOverlaps), so only the kept hits are held in memory.
+
+    Parameters:
+        hits: iterable of (target, query, e_value, score, length, start, end)
+        lookups: dict of {dbname: IDs in the lookup table of the view}
+        writer: if given, every hit is also written to it as a line of the raw hits file
+
+    Returns:
+        dict of {dbname: {target: [(query, e_value, score, length, start, end)]}}, see filterHits
+    '''
+    BH_views = {dbname:dict() for dbname in lookups}
+    views = [(dbLookup, BH_views[dbname]) for dbname,dbLookup in lookups.items()]
+    for target,query,e_value,score,length,start,end in hits:
+        if writer is not None:
+            print(target, query, f'{e_value:.1E}', f"{score:.1f}", length, start, end, sep='\t', file=writer)
+        item = None
+        for dbLookup,BH_target in views:
             # Check if Query is in the Database
-            if not re.search(query, dbLookup, re.MULTILINE):
+            if query not in dbLookup:
                 continue
-            
-            # Count Proper Hits
-            # 1) Overlapping: Count best score
-            # 2) Unique: Count both
-            if target not in BH_target:
-                BH_target[target] = [(query, e_value, score, length, start, end)]
-            else: # More than one match/target
-                #keys = list(BH_target[target].keys())
+            if item is None:
                 item = (query, e_value, score, length, start, end)
-                add = False
-                overlap = False
-                for c,match in enumerate(BH_target[target]):
-                    # Check for overlap
-                    if start <= match[5] and end >= match[4]:
-                        overlap_len = min(end, match[5]) - max(start, match[4])
-                        if overlap_len > 10:
-                            overlap = True
-                            # Equal Score
-                            if e_value == match[1] and score == match[2]:
-                                add = True
-                            # Winner takes all
-                            elif e_value < match[1]:
-                                BH_target[target][c] = item
-                            elif e_value == match[1]:
-                                if score > match[2]:
-                                    BH_target[target][c] = item
-                if add or not overlap:
-                    # Equal score OR Dual domain
-                    BH_target[target] += [item]
-            # next line
-            continue
-    # Write filtered overlaps to file
+            kept = BH_target.get(target)
+            if kept is None:
+                # starts, hits sorted by start, longest hit kept
+                BH_target[target] = [[start], [item], end - start]
+            else:
+                resolveOverlaps(kept, item)
+
+    for BH_target in BH_views.values():
+        for target,kept in BH_target.items():
+            BH_target[target] = kept[1]
+    return BH_views
+
+
+def resolveOverlaps(kept:list, item:tuple):
+    '''Resolve a new hit against the hits kept for its target.
+
+    Count Proper Hits
+    1) Overlapping (more than 10 aa): Winner takes all, best e-value, then best score
+    2) Equal e-value and score: Count both
+    3) Unique: Count both
+
+    The hits are resolved in the order they arrive: a new hit replaces the
+    kept hits it beats, and is kept if it ties with one or overlaps none.
+    Kept hits are held sorted by start, so only those starting within reach
+    of the new hit are compared, and duplicates are kept once.
+
+    Parameters:
+        kept (list): [starts, hits, reach] of the target, hits are (query, e_value, score, length, start, end)
+            sorted by start, and reach the length of the longest hit kept so far
+        item (tuple): the new hit
+
+    Returns:
+        kept, updated in place
+    '''
+    starts,matches,reach = kept
+    query,e_value,score,length,start,end = item
+    # a hit overlaps another by more than 10 aa if each starts more than 10 aa before the other ends
+    first = start + 10
+    last = end - 10
+    if len(starts) <= SWEEP_MIN:
+        lo,hi = 0,len(starts)
+    else:
+        # kept hits overlapping by more than 10 aa start in (start+10-reach, end-10)
+        lo = bisect.bisect_right(starts, first - reach)
+        hi = bisect.bisect_left(starts, last, lo)
+    add = False
+    overlap = False
+    replaced = None
+    if first >= end:
+        # too short to overlap by more than 10 aa
+        hi = lo
+    for c in range(lo, hi):
+        match = matches[c]
+        if match[4] < last and match[5] > first and match[5] - match[4] > 10:
+            overlap = True
+            # Equal Score
+            if e_value == match[1] and score == match[2]:
+                add = True
+            # Winner takes all
+            elif e_value < match[1] or (e_value == match[1] and score > match[2]):
+                if replaced is None:
+                    replaced = [c]
+                else:
+                    replaced.append(c)
+    if replaced:
+        for c in reversed(replaced):
+            del starts[c]
+            del matches[c]
+    elif overlap and not add:
+        return kept
+    # a duplicate of a kept hit ties with it, or is too short to overlap it
+    if (add or end - start <= 10) and item in matches:
+        return kept
+    # Equal score OR Dual domain OR Replacing worse hits
+    c = bisect.bisect_right(starts, start)
+    starts.insert(c, start)
+    matches.insert(c, item)
+    if end - start > reach:
+        kept[2] = end - start
+    return kept
+
+
+# Write filtered hits
+def writeFiltered(BH_target:dict, outfile:Path):
+    outfile.parent.mkdir(parents=True, exist_ok=True)
     with outfile.open('w') as writer:
         print("target", "query", "e-value", "score", "length", "start", "end", sep='\t', file=writer)
         for target in sorted(BH_target):
-            for match in set(BH_target[target]):
+            for match in BH_target[target]:
                 query, e_value, score, length, start, end = match
                 print(target, query, e_value, score, length, start, end, sep='\t', file=writer)
-
     return outfile
+
+
+# Filter HMM results
+def filterHMM(hmm_tsv:Path, outfile:Path, dbpath:Path, dbname:str):
+    '''Filter the hits of an HMM search for the database view dbname.
+
+    KOFam files are searched once and filtered once per view (KEGG, FOAM),
+    each view using its own lookup table.
+    '''
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+
+    dbLookup = cerberus_lookup.loadLookup(dbpath, dbname)['rows']
+
+    logfile = outfile.with_suffix('.log')
+    with logfile.open('w') as logger:
+        BH_target = filterHits(readHits(hmm_tsv, logger), dbLookup)
+
+    return writeFiltered(BH_target, outfile)
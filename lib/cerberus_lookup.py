@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""cerberus_lookup.py: Module for indexed access to the database lookup tables
+The lookup table (.tsv) of each database is indexed by ID once, and the index
+is saved next to the table (.tsv.idx) to be reused by later runs.
+"""
+
+import os
+import re
+import pickle
+from pathlib import Path
+
+
+# Lookup tables loaded by this process {tsv path: (mtime, size, index)}
+LOOKUP_CACHE = dict()
+
+
+# Path of the lookup table of a database
+def lookupPath(dbpath:os.PathLike, dbname:str):
+    dbpath = Path(dbpath)
+    while dbpath.suffixes:
+        dbpath = dbpath.with_suffix('')
+    match = re.search(r"^KOFam_.*_([A-Z]+)$", dbname)
+    if match:
+        return dbpath.with_name(f'{match.group(1)}.tsv')
+    return dbpath.with_suffix('.tsv')
+
+
+# Index a lookup table by ID
+def indexLookup(tsv:os.PathLike):
+    '''Read a lookup table into an index.
+
+    Returns:
+        dict with 'columns': the header of the table,
+        and 'rows': {ID: [row, ...]}, each row a list of the fields in the table
+    '''
+    rows = dict()
+    with open(tsv) as reader:
+        columns = reader.readline().rstrip('\n').split('\t')
+        col_id = columns.index('ID')
+        for line in reader:
+            line = line.rstrip('\n').split('\t')
+            ID = line[col_id]
+            if ID not in rows:
+                rows[ID] = list()
+            rows[ID] += [line]
+    return dict(columns=columns, rows=rows)
+
+
+# Load the index of a lookup table
+def loadLookup(dbpath:os.PathLike, dbname:str):
+    '''Load the indexed lookup table of a database.
+
+    The index is kept in memory for the life of the process, and saved next
+    to the lookup table. Both are rebuilt if the table has been modified.
+    '''
+    tsv = lookupPath(dbpath, dbname).resolve()
+    stat = tsv.stat()
+    if tsv in LOOKUP_CACHE and LOOKUP_CACHE[tsv][:2] == (stat.st_mtime_ns, stat.st_size):
+        return LOOKUP_CACHE[tsv][2]
+
+    index = None
+    idx = tsv.with_name(tsv.name + '.idx')
+    try:
+        with idx.open('rb') as reader:
+            mtime,size,index = pickle.load(reader)
+        if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+            index = None
+    except Exception:
+        index = None
+    if index is None:
+        index = indexLookup(tsv)
+        # write to a temporary file so other processes never read a partial index
+        tmp = idx.with_name(f"{idx.name}.{os.getpid()}.tmp")
+        try:
+            with tmp.open('wb') as writer:
+                pickle.dump((stat.st_mtime_ns, stat.st_size, index), writer, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, idx)
+        except OSError:
+            # database folder is read only, keep the index in memory only
+            tmp.unlink(missing_ok=True)
+
+    LOOKUP_CACHE[tsv] = (stat.st_mtime_ns, stat.st_size, index)
+    return index
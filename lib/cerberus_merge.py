@@ -8,6 +8,8 @@ import re
 from pathlib import Path
 import subprocess
 
+from . import cerberus_compress
+
 
 # Merge paired end reads
 def mergePairedEnd(pairedFastq, config, subdir):
@@ -16,8 +18,9 @@ def mergePairedEnd(pairedFastq, config, subdir):
     R1 = pairedFastq[0]
     R2 = pairedFastq[1]
     prefix = os.path.basename(R1)
-    merged = os.path.join(outpath, prefix.replace('_R1', '_merged'))
-    merged = outpath / prefix.replace('_R1', '_merged')
+    # FLASH compresses its outputs with -z
+    ext = cerberus_compress.outputExt('.fastq', config.get('COMPRESS'))
+    merged = outpath / (cerberus_compress.splitExt(R1)[0].replace('_R1', '_merged') + ext)
 
     done = outpath / "complete"
     if not config['REPLACE'] and done.exists() and merged.exists():
@@ -28,7 +31,7 @@ def mergePairedEnd(pairedFastq, config, subdir):
     #read stats
     lengths = list()
     for seq in [R1,R2]:
-        with open(seq) as reader:
+        with cerberus_compress.openFile(seq, 'rt', config.get('CPUS', 1)) as reader:
             line = reader.readline()
             while line:
                 if re.search(r'^[+]$', line):
@@ -43,11 +46,16 @@ def mergePairedEnd(pairedFastq, config, subdir):
     _99th = round(mu + (3*std))
     #print(R1, mu, var, std, _99th, max(lengths), file=sys.stderr)
 
+    R1 = cerberus_compress.plainFile(R1, outpath)
+    R2 = cerberus_compress.plainFile(R2, outpath)
     command = f"{config['EXE_FLASH']} {R1} {R2} -d {outpath} -o {prefix} -M {_99th} --interleaved-output"
+    if config.get('COMPRESS'):
+        command += " -z"
     with open(f"{outpath}/stdout.txt", 'w') as fout, open(f"{outpath}/stderr.txt", 'w') as ferr:
         subprocess.run(command, shell=True, check=True, stdout=fout, stderr=ferr)
 
-    command = f"cat {outpath}/*.fastq > {merged}"
+    # gzip members can be concatenated
+    command = f"cat {outpath}/{prefix}.*{ext} > {merged}"
     subprocess.run(command, shell=True, check=True)
 
     done.touch()
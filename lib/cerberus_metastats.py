@@ -7,6 +7,8 @@ Uses countfasta.py
 import os
 import subprocess
 
+from . import cerberus_compress
+
 
 # Check contigs
 def getReadStats(contig, config, subdir):
@@ -15,11 +17,15 @@ def getReadStats(contig, config, subdir):
     
     # Metaome_stats
     try:
-        command = [ config['EXE_COUNT_ASSEMBLY'], '-f', contig, '-i 100' ]
+        # countAssembly.py only reads plain files
+        plain = cerberus_compress.plainFile(contig, path, keep=())
+        command = [ config['EXE_COUNT_ASSEMBLY'], '-f', plain, '-i 100' ]
         with open(f"{path}/stderr.txt", 'w') as ferr, open(f"{path}/read-stats.txt", 'w') as writer:
             proc = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=ferr)
             stats = proc.stdout.decode('utf-8', 'ignore')
             writer.write(stats)
+        if plain != contig:
+            os.remove(plain)
     except Exception as e:
         print(e)
         print("Error: countAssembly.py failed: " + subdir)
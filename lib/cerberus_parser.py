@@ -10,201 +10,146 @@ def warn(*args, **kwargs):
 import warnings
 warnings.warn = warn
 
-import re
+import heapq
+import shutil
+import tempfile
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+from . import cerberus_lookup
 
-def top5s(hmm_tsv:dict, outfile:Path):
-    outfile.parent.mkdir(0o777, True, True)
 
-    # Calculate Best Hit
-    BH_top5 = {}
-    for hmm,filename in hmm_tsv.items():
-        with open(filename, "r") as reader:
-            reader.readline()
-            for line in reader:
-                line = line.split('\t')
-                target = line[0]
-                query = line[1]
-                e_value = line[2]
-                score = float(line[3])
-                ec = '' #TODO: Match query to EC
-
-                # store top 5 per query
-                match = [target, query, ec, e_value, score, hmm]
-                if target not in BH_top5:
-                    BH_top5[target] = [match]
-                elif len(BH_top5[target]) < 5:
-                    BH_top5[target].append(match)
-                else:
-                    BH_top5[target].sort(key = lambda x: x[3], reverse=False)
-                    if score > float(BH_top5[target][0][3]):
-                        BH_top5[target][0] = match
-
-    # Save Top 5 hits tsv rollup
-    with outfile.open('w') as writer:
-        print("Target Name", "ID", "EC value", "E-Value (sequence)", "Score (domain)", "hmmDB", sep='\t', file=writer)
-        for target in sorted(BH_top5.keys()):
-            BH_top5[target].sort(key = lambda x: x[3], reverse=True)
-            for line in BH_top5[target]:
-                print(*line, sep='\t', file=writer)
-    return outfile
-
-
-def top5(hmm_tsv:Path, outfile:Path):
-    outfile.parent.mkdir(0o777, True, True)
-
-    # Calculate Best Hit
-    BH_top5 = {}
-    with open(hmm_tsv, "r") as reader:
-        reader.readline()
-        for line in reader:
-            line = line.split('\t')
-            target = line[0]
-            query = line[1]
-            e_value = line[2]
-            score = float(line[3])
-            ec = '' #TODO: Match query to EC
-
-            # store top 5 per query
-            match = [target, query, ec, e_value, score]
-            if target not in BH_top5:
-                BH_top5[target] = [match]
-            elif len(BH_top5[target]) < 5:
-                BH_top5[target].append(match)
-            else:
-                BH_top5[target].sort(key = lambda x: x[3], reverse=False)
-                if score > float(BH_top5[target][0][3]):
-                    BH_top5[target][0] = match
-
-    # Save Top 5 hits tsv rollup
-    with outfile.open('w') as writer:
-        print("Target Name", "ID", "EC value", "E-Value (sequence)", "Score (domain)", sep='\t', file=writer)
-        for target in sorted(BH_top5.keys()):
-            BH_top5[target].sort(key = lambda x: x[3], reverse=True)
-            for line in BH_top5[target]:
-                print(*line, sep='\t', file=writer)
-    return outfile
+# Bounded top-N list of hits, kept as a min-heap on score
+def pushTop(heap:list, n:int, score:float, order:int, row):
+    # ties on score keep the hit seen first
+    item = (score, -order, row)
+    if len(heap) < n:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+    return
 
 
-def parseHmmer(hmm_tsv, config, subdir, dbname, dbpath):
-    path = Path(config['DIR_OUT'], subdir)
-    path.mkdir(exist_ok=True, parents=True)
+# Sort a top-N heap from best to worst score
+def sortTop(heap:list):
+    return [item[2] for item in sorted(heap, key=lambda x: (-x[0], -x[1]))]
 
-    #done = path / "complete"
-    #if not config['REPLACE'] and done.exists():
-    #    print("AH CRAP!!!")
-    #    rollup_files = dict()
-    #    outfile = Path(path, f"HMMER_BH_{dbname}_rollup.tsv")
-    #    if outfile.exists():
-    #        rollup_files[name] = outfile
-    #        return rollup_files
-    #done.unlink(missing_ok=True)
 
+def parseHmmer(hmm_tsvs:dict, config:dict, subdir:str, dbhmms:dict):
+    '''Aggregate the filtered hits of all databases of a sample in a single pass.
 
-    minscore = config["MINSCORE"]
+    Parameters:
+        hmm_tsvs (dict): {dbname: filtered hits file}
+        config (dict): Settings, uses MINSCORE and TOP_HITS (number of hits to keep, default 5)
+        subdir (str): Output folder, relative to config['DIR_OUT'], named after the sample
+        dbhmms (dict): {dbname: path to the HMM file}
 
-    top5File = Path(path, f"HMMER-{dbname}_top_5.tsv")
+    Writes:
+        HMMER_top_{N}.tsv: Best N hits per target across all databases
+        top_{N}-{sample}.tsv: Same, without the database column
+        HMMER-{dbname}_top_{N}.tsv: Best N hits per query (HMM), per database
+        counts_{dbname}.tsv, HMMER_BH_{dbname}_rollup2.tsv: ID counts and rollup, per database
 
+    Returns:
+        dict of {dbname: rollup file}
+    '''
+    path = Path(config['DIR_OUT'], subdir)
+    path.mkdir(exist_ok=True, parents=True)
 
-    # Calculate Best Hit
-    BH_query = {}
-    BH_top5 = {}
-    #"target", "query", "e-value", "score", "length", "start", "end"
-    with open(hmm_tsv, "r") as reader:
-        for line in reader:
-            line = line.split('\t')
-            try:
-                target = line[0]
-                query = line[1]
-                e_value = line[2]
-                line[3] = float(line[3])
-                score = line[3]
-                length = int(line[4])
-                start = int(line[5])
-                end = int(line[6])
-            except:
-                continue
-            if score < minscore:            # Skip scores less than minscore
-                print("DEBUG: MINSCORE DETECTED")
-                continue
+    minscore = config["MINSCORE"]
+    topN = config.get('TOP_HITS', 5)
 
-            # store top 5 per query
-            if query not in BH_top5:
-                BH_top5[query] = [line]
-            elif len(BH_top5[query]) < 5:
-                BH_top5[query].append(line)
-            else:
-                BH_top5[query].sort(key = lambda x: x[3], reverse=False)
-                if score > float(BH_top5[query][0][3]):
-                    BH_top5[query][0] = line
-
-            # Check for Best Score per query
-            if query not in BH_query:
-                BH_query[query] = line
-            elif score > float(BH_query[query][3]):
-                BH_query[query] = line
-
-    # Save Top 5 hits tsv rollup
-    with top5File.open('w') as writer:
-        print("Target Name", "ID", "EC value", "E-Value (sequence)", "Score (domain)", file=writer, sep='\t')
-        for query in sorted(BH_top5.keys()):
-            BH_top5[query].sort(key = lambda x: x[3], reverse=True)
-            for line in BH_top5[query]:
-                id = [i for i in line[1].split(',')]
-                ec = []
-                print(line[0], ','.join(id), ','.join(ec), line[2], line[3], file=writer, sep='\t')
-
-    # Create dictionary with found IDs and counts
-    ID_counts = {}
-    for line in BH_query.values():
-        IDs = [ID for ID in line[1].split(",")]
-        for ID in IDs:
-            if ID not in ID_counts:
-                ID_counts[ID] = 0
-            ID_counts[ID] += 1
-
-    # Write rollup files to disk
-    dbRollup = rollup(ID_counts, dbname, dbpath, path)
+    # Calculate Best Hits
+    order = 0
+    BH_target = dict() # top N per target, all databases
     rollup_files = dict()
-    if len(dbRollup) > 1:
-        outfile = Path(path, f"HMMER_BH_{dbname}_rollup2.tsv")
-        with open(outfile, 'w') as writer:
-            for line in dbRollup:
+    #"target", "query", "e-value", "score", "length", "start", "end"
+    for dbname,hmm_tsv in hmm_tsvs.items():
+        BH_query = dict() # best hit per query
+        BH_top = dict() # top N per query
+        with open(hmm_tsv, "r") as reader:
+            for line in reader:
+                line = line.split('\t')
+                try:
+                    target = line[0]
+                    query = line[1]
+                    e_value = line[2]
+                    score = float(line[3])
+                    length = int(line[4])
+                    start = int(line[5])
+                    end = int(line[6])
+                except:
+                    continue
+                order += 1
+
+                # store top N per target
+                if target not in BH_target:
+                    BH_target[target] = list()
+                pushTop(BH_target[target], topN, score, order, [target, query, '', e_value, score, dbname]) #TODO: Match query to EC
+
+                if score < minscore:            # Skip scores less than minscore
+                    print("DEBUG: MINSCORE DETECTED")
+                    continue
+
+                # store top N per query
+                if query not in BH_top:
+                    BH_top[query] = list()
+                pushTop(BH_top[query], topN, score, order, [target, query, '', e_value, score])
+
+                # Check for Best Score per query
+                if query not in BH_query or score > BH_query[query][1]:
+                    BH_query[query] = (target, score)
+
+        # Save Top N hits per query
+        with Path(path, f"HMMER-{dbname}_top_{topN}.tsv").open('w') as writer:
+            print("Target Name", "ID", "EC value", "E-Value (sequence)", "Score (domain)", file=writer, sep='\t')
+            for query in sorted(BH_top.keys()):
+                for line in sortTop(BH_top[query]):
+                    print(*line, file=writer, sep='\t')
+
+        # Create dictionary with found IDs and counts
+        ID_counts = {}
+        for query in BH_query.keys():
+            for ID in query.split(","):
+                if ID not in ID_counts:
+                    ID_counts[ID] = 0
+                ID_counts[ID] += 1
+
+        # Write rollup files to disk
+        dbRollup = rollup(ID_counts, dbname, dbhmms[dbname], path)
+        if len(dbRollup) > 1:
+            outfile = Path(path, f"HMMER_BH_{dbname}_rollup2.tsv")
+            with open(outfile, 'w') as writer:
+                for line in dbRollup:
+                    print(*line, sep='\t', file=writer)
+            rollup_files[dbname] = outfile
+
+    # Save Top N hits per target
+    sample = Path(subdir).name
+    with Path(path, f"HMMER_top_{topN}.tsv").open('w') as writer, Path(path, f"top_{topN}-{sample}.tsv").open('w') as writer_nodb:
+        print("Target Name", "ID", "EC value", "E-Value (sequence)", "Score (domain)", "hmmDB", sep='\t', file=writer)
+        print("Target Name", "ID", "EC value", "E-Value (sequence)", "Score (domain)", sep='\t', file=writer_nodb)
+        for target in sorted(BH_target.keys()):
+            for line in sortTop(BH_target[target]):
                 print(*line, sep='\t', file=writer)
-        rollup_files[dbname] = outfile
+                print(*line[:-1], sep='\t', file=writer_nodb)
 
-    #done.touch()
     return rollup_files
 
 ######### Roll-Up #########
 def rollup(COUNTS:dict, dbname:str, dbpath:Path, outpath:str):
-    while(dbpath.suffixes):
-        dbpath = Path(dbpath.with_suffix(''))
-    dbpath = dbpath.with_suffix('.tsv')
-    if dbname.startswith("KOFam"):
-        match = re.search(r"KOFam_.*_([A-Z]+)", dbname).group(1)
-        dbpath = dbpath.with_name(f'{match}.tsv')
-
-    dbLookup = dict()
-    with open(dbpath) as reader:
-        cols = reader.readline().rstrip('\n').split('\t')
-        for line in reader:
-            line = line.rstrip('\n').split('\t')
-            ID = line[cols.index('ID')]    
-            if line[cols.index('Function')]:
-                if ID not in dbLookup:
-                    dbLookup[ID] = list()
-                dbLookup[ID] += [line]
+    dbLookup = cerberus_lookup.loadLookup(dbpath, dbname)
+    cols = dbLookup['columns']
+    col_function = cols.index('Function')
 
     dbRollup = [cols+['Count']]
     count_file = Path(outpath, f'counts_{dbname}.tsv')
     with count_file.open('w') as count_writer, Path(outpath, 'lookup.err').open('w') as errlog:
         print('ID', 'count', sep='\t', file=count_writer)
         for ID,count in sorted(COUNTS.items()):
-            if ID in dbLookup:
-                rows:list = dbLookup[ID]
+            rows:list = [row for row in dbLookup['rows'].get(ID, []) if row[col_function]]
+            if rows:
                 print(ID, count, sep='\t', file=count_writer)
                 for row in rows:
                     dbRollup += [row+[count]]
@@ -231,32 +176,27 @@ def createCountTables(rollup_files:dict, config:dict, subdir: str):
             df = pd.read_csv(filepath, sep='\t')
         except:
             continue
-        dictCount = {}
-        for i,row in df.iterrows():
-            for colName,colData in row.items():
-                if not colName.startswith('L'):
-                    continue
+        # one cell per row and L* level or Function, kept in the order the rows are read
+        columns = [col for col in df.columns if col.startswith('L')] + ['Function']
+        cells = list()
+        for i,colName in enumerate(columns):
+            colData = df[colName].astype(object)
+            keep = colData.to_numpy().astype(bool)
+            text = colData.where(colData.notna(), 'nan').astype(str)
+            if colName == 'Function':
+                ids = df['ID'].astype(object)
+                name = ids.where(ids.notna(), 'nan').astype(str) + ': ' + text
+                cell = pd.DataFrame(dict(Id=ids, Name=name, Level='Function'))
+            else:
                 level = colName[1]
-                name = colData
-                if name:
-                    name = f"lvl{level}: {name}"
-                    if name not in dictCount:
-                        dictCount[name] = [level, 0, ""]
-                    dictCount[name][1] += row['Count']
-            name = row.Function
-            if not name:
-                continue
-            name = f"{row.ID}: {name}"
-            if name not in dictCount:
-                dictCount[name] = ['Function', 0, row.ID]
-            dictCount[name][1] += row['Count']
-        data = {
-        'Id':[x[2] for x in dictCount.values()],
-        'Name':list(dictCount.keys()),
-        'Level':[x[0] for x in dictCount.values()],
-        'Count':[x[1] for x in dictCount.values()]}
-
-        df = pd.DataFrame(data=data)
+                cell = pd.DataFrame(dict(Id="", Name=f"lvl{level}: " + text, Level=level), index=df.index)
+            cell['Count'] = df['Count']
+            cell['order'] = np.arange(len(df)) * len(columns) + i
+            cells.append(cell[keep])
+        df = pd.concat(cells, ignore_index=True).sort_values('order', kind='stable')
+        counts = df.groupby('Name', sort=False)['Count'].sum()
+        df = df.drop_duplicates('Name')[['Id', 'Name', 'Level']]
+        df['Count'] = counts.to_numpy()
         df.fillna(0, inplace=True)
         df.to_csv(outpath, index=False, header=True, sep='\t')
         dfCounts[dbName] = outpath
@@ -265,37 +205,88 @@ def createCountTables(rollup_files:dict, config:dict, subdir: str):
     return dfCounts
 
 
+# Rows of a tsv file sorted by ID, as (ID, order, values)
+def readSorted(reader, order:int, width:int):
+    for line in reader:
+        line = line.split()
+        if not line: # End of table
+            return
+        yield line[0], order, line[1:width+1]
+
+
+# Merge sorted tables on ID into one wide table
+def mergeSorted(tsv_files:list, out_file:Path, header:list=None):
+    '''Streaming k-way merge of tables sorted by ID.
+
+    Values missing from a table are filled with 0. Returns the number of rows written.
+    '''
+    readers = list()
+    files = list()
+    zeros = list()
+    columns = list()
+    try:
+        for order,tsv in enumerate(tsv_files):
+            files.append(open(tsv))
+            names = files[-1].readline().split()[1:]
+            columns += names
+            zeros.append('\t'.join(['0']*len(names)))
+            readers.append(readSorted(files[-1], order, len(names)))
+        rows = 0
+        with open(out_file, 'w') as writer:
+            print('\t'.join(header if header else ['ID']+columns), file=writer)
+            ID = None
+            line = None
+            last = -1
+            for rowID,order,values in heapq.merge(*readers):
+                # an ID repeated in the same table starts a new row
+                if rowID != ID or order == last:
+                    if line:
+                        print(ID, '\t'.join(line), sep='\t', file=writer)
+                        rows += 1
+                    ID = rowID
+                    line = zeros.copy()
+                line[order] = '\t'.join(values)
+                last = order
+            if line:
+                print(ID, '\t'.join(line), sep='\t', file=writer)
+                rows += 1
+    finally:
+        for reader in files:
+            reader.close()
+    return rows
+
+
 # Merge TSV Files
-def merge_tsv(tsv_list:dict, out_file:Path):
+def merge_tsv(tsv_list:dict, out_file:Path, max_open:int=256):
+    '''Merge the sorted count tables of each sample into a table with one column per sample.
+
+    At most max_open tables are read at once. Larger sets are merged in groups
+    into temporary tables, which are then merged in turn.
+    The table is written to a temporary file, and out_file is only replaced if it has rows.
+    '''
     names = sorted(list(tsv_list.keys()))
-    file_list = dict()
-    lines = dict()
-    IDS = set()
-    for name in names:
-        file_list[name] = open(tsv_list[name])
-        file_list[name].readline() # skip header
-        lines[name] = file_list[name].readline().split()
-        if lines[name]:
-            IDS.add(lines[name][0])
-    if len(IDS) == 0: # Fail if nothing to merge
-        return False
-    with open(out_file, 'w') as writer:
-        print("ID", '\t'.join(names), sep='\t', file=writer)
-        while IDS:
-            ID = sorted(IDS)[0]
-            IDS.remove(ID)
-            line = [ID]
-            for name in names:
-                if not lines[name]: # End of file
-                    line.append('0')
-                elif lines[name][0] > ID: # File ID comes after current
-                    line.append('0')
-                else:
-                    line.append(lines[name][1])
-                    lines[name] = file_list[name].readline().split()
-                    if lines[name]:
-                        IDS.add(lines[name][0])
-            print('\t'.join(line), file=writer)
-    for name in names:
-        file_list[name].close()
+    tsv_files = [tsv_list[name] for name in names]
+    out_file = Path(out_file)
+    tmp_file = out_file.with_name(f"{out_file.name}.tmp")
+    tmpdir = None
+    try:
+        level = 0
+        while len(tsv_files) > max_open:
+            if tmpdir is None:
+                tmpdir = Path(tempfile.mkdtemp(prefix='merge_', dir=out_file.parent))
+            groups = list()
+            for i in range(0, len(tsv_files), max_open):
+                group = Path(tmpdir, f'{level}_{len(groups)}.tsv')
+                mergeSorted(tsv_files[i:i+max_open], group)
+                groups.append(group)
+            tsv_files = groups
+            level += 1
+        rows = mergeSorted(tsv_files, tmp_file, ['ID']+names)
+        if rows == 0: # Fail if nothing to merge
+            return False
+        tmp_file.replace(out_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
     return True
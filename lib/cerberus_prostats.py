@@ -4,76 +4,109 @@
 
 """
 
-import re
 from pathlib import Path
+from array import array
+import numpy as np
 import pandas as pd
 import statistics as stat
 
+from . import cerberus_faidx
+from . import cerberus_lookup
+
+
+# Values read as missing by pandas.read_csv, these are written as empty fields
+NA_VALUES = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+             "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+
+# Annotation (Function, EC, Gene) of each ID in an indexed lookup table
+def annotationTable(dbLookup:dict):
+    cols = dbLookup['columns']
+    fields = [cols.index(col) if col in cols else None for col in ('Function', 'EC', 'Gene')]
+    table = dict()
+    for ID,rows in dbLookup['rows'].items():
+        row = rows[0]
+        table[ID] = tuple("" if i is None or row[i] in NA_VALUES else row[i] for i in fields)
+    return table
+
 
 def getStats(faa:str, hmm_tsv:dict, dfCount:dict, config:dict, dbhmms:dict, summary_out:Path, fasta_prefix:Path):
     minscore = config["MINSCORE"]
 
     # sum up proteins in FASTA file
+    # proteins are kept by index, in the order of the FASTA file, with their lengths
     protein_index = dict()
-    proteins = dict()
+    protein_length = array('q')
+    fasta_index = None
     if faa:
-        with open(faa, "r") as reader:
-            name = ""
-            line = reader.readline()
-            while line:
-                if line.startswith('>'):
-                    name = line[1:].rstrip().split(sep=None, maxsplit=1)[0]
-                    protein_index[name] = reader.tell()
-                    length = 0
-                    line = reader.readline()
-                    while line:
-                        if line.startswith('>'):
-                            break
-                        length += len(line.strip())
-                        line = reader.readline()
-                    proteins[name] = dict(count=0, found=0, length=length)
-                    continue
-                line = reader.readline()
+        fasta_index = cerberus_faidx.FastaIndex(faa, config.get('DIR_INDEX'))
+        for name in fasta_index:
+            protein_index[name] = len(protein_index)
+            protein_length.append(fasta_index.length(name))
     #else:
 
     # sum up proteins in HMMER file
-    hmmHits = dict()
-    for dbname,filename in hmm_tsv.items():
-    #with open(hmm_tsv, "r") as reader:
-        reader = open(filename, "r")
-        for i,line in enumerate(reader,1):
-            #"target", "query", "e-value", "score", "length", "start", "end"
-            line = line.split('\t')
-            try:
-                target = line[0]
-                query = line[1]
-                evalue = float(line[2])
-                score = float(line[3])
-                length = int(line[4])
-                start = int(line[5])
-                end = int(line[6])
-            except:
-                continue
-
-            # Add to hmm tsv dict
-            if target not in hmmHits:
-                hmmHits[target] = list()
-            hmmHits[target].append([query, evalue, score, length, start, end, dbname])
-
-            # Count protein matches
-            if target in proteins:
-                proteins[target]['count'] += 1
-                if score >= minscore:
-                    proteins[target]['found'] += 1
-            else:
-                if faa:
-                    print("WARNING: Target on line", i, "of HMMER target not in protein fasta:", hmm_tsv)
+    # hits are kept in columns, with targets, queries and databases as integer codes
+    query_index = dict()
+    hit_target = array('q')
+    hit_query = array('q')
+    hit_db = array('q')
+    hit_evalue = array('d')
+    hit_score = array('d')
+    hit_length = array('q')
+    hit_start = array('q')
+    hit_end = array('q')
+    for db,(dbname,filename) in enumerate(hmm_tsv.items()):
+        with open(filename, "r") as reader:
+            for i,line in enumerate(reader,1):
+                #"target", "query", "e-value", "score", "length", "start", "end"
+                line = line.split('\t')
+                try:
+                    target = line[0]
+                    query = line[1]
+                    evalue = float(line[2])
+                    score = float(line[3])
+                    length = int(line[4])
+                    start = int(line[5])
+                    end = int(line[6])
+                except:
                     continue
-                else: #TODO: There is probably a better way to do this.
-                    proteins[target] = dict(count=1, found=0, length=length)
-                    if score >= minscore:
-                        proteins[target]['found'] += 1
-        reader.close()
+
+                if target not in protein_index:
+                    if faa:
+                        print("WARNING: Target on line", i, "of HMMER target not in protein fasta:", hmm_tsv)
+                        continue
+                    else: #TODO: There is probably a better way to do this.
+                        protein_index[target] = len(protein_index)
+                        protein_length.append(length)
+                if query not in query_index:
+                    query_index[query] = len(query_index)
+
+                # Add to hit columns
+                hit_target.append(protein_index[target])
+                hit_query.append(query_index[query])
+                hit_db.append(db)
+                hit_evalue.append(evalue)
+                hit_score.append(score)
+                hit_length.append(length)
+                hit_start.append(start)
+                hit_end.append(end)
+    queries = list(query_index.keys())
+    dbnames = list(hmm_tsv.keys())
+    del query_index
+
+    hit_target, hit_query, hit_db, hit_length, hit_start, hit_end = [np.frombuffer(col, dtype=np.int64)
+        for col in (hit_target, hit_query, hit_db, hit_length, hit_start, hit_end)]
+    hit_evalue, hit_score = [np.frombuffer(col, dtype=np.float64) for col in (hit_evalue, hit_score)]
+
+    # Count protein matches
+    count = np.bincount(hit_target, minlength=len(protein_index))
+    found = np.bincount(hit_target[hit_score >= minscore], minlength=len(protein_index))
+
+    # Order hits by target, then by evalue, keeping the file order of ties
+    order = np.argsort(hit_evalue, kind='stable')
+    order = order[np.argsort(hit_target[order], kind='stable')]
+    hit_bounds = np.concatenate(([0], np.cumsum(count)))
 
     # Annotate proteins
     #TODO: use evalue as well as score for best comparison
@@ -83,68 +116,50 @@ def getStats(faa:str, hmm_tsv:dict, dfCount:dict, config:dict, dbhmms:dict, summ
     dfLookup = dict()
     hmmFiles = dict()
     for dbname,dbpath in dbhmms.items():
-        # Load .tsv of same name as hmm
-        while Path(dbpath).suffixes:
-            dbpath = Path(dbpath).with_suffix('')
-        dbLookup = dbpath.with_suffix('.tsv')
-        if dbname.startswith("KOFam"):
-            dbLookup = re.search(r"KOFam_.*_([A-Z]+)", dbname).group(1)
-            dbLookup = dbpath.with_name(f'{dbLookup}.tsv')
-        dfLookup[dbname] = pd.read_csv(dbLookup, sep='\t').fillna('')
+        # Annotations keyed by ID from the indexed .tsv of same name as hmm
+        dfLookup[dbname] = annotationTable(cerberus_lookup.loadLookup(dbpath, dbname))
         # open outfile for hmm matches
         hmmFiles[dbname] = open(summary_out.with_stem(f"annotation_summary_{dbname}"), 'w')
         print("target", "product", "best_hit", "evalue", "score", "EC", "gene", "ORF_start", "ORF_end", "product_start", "product_end", "product_length", "ORF_length-aa", sep='\t', file=hmmFiles[dbname])
     gff = Path(faa).with_suffix(".gff")
     if gff.exists():
-        gff = [x.split() for x in open(gff).readlines() if not x.startswith("#")]
+        gff = [x.split()[3:5] for x in open(gff) if not x.startswith("#")]
     else:
         gff = None
-    with open(summary_out, 'w') as writer, fasta_prefix.open('w') as faa_writer, open(faa) as faa_reader:
+    with open(summary_out, 'w') as writer, fasta_prefix.open('wb') as faa_writer:
         print(*header, sep='\t', file=writer)
-        for i,target in enumerate(proteins.keys()):
+        for i,target in enumerate(protein_index.keys()):
             if gff:
-                orf_start, orf_end = gff[i][3:5]
+                orf_start, orf_end = gff[i]
             else:
                 orf_start,orf_end = ["N/A", "N/A"]
             empty[6] = orf_start
             empty[7] = orf_end
-            if target in hmmHits:
-                # sort by score
-                hmmHits[target].sort(key = lambda x: x[1], reverse=False)
+            if count[i]:
+                # hits of the target, sorted by evalue
+                hits = order[hit_bounds[i]:hit_bounds[i+1]]
+                hits = list(zip([queries[x] for x in hit_query[hits]], hit_evalue[hits].tolist(), hit_score[hits].tolist(),
+                                hit_length[hits].tolist(), hit_start[hits].tolist(), hit_end[hits].tolist(),
+                                [dbnames[x] for x in hit_db[hits]]))
                 # Best Match
-                query,eval,score,length_orf,start,end,dbname = hmmHits[target][0]
-                name,EC,gene = ["", "", ""]
-                rows = pd.DataFrame(dfLookup[dbname][dfLookup[dbname].ID==query])
-                if not rows.empty:
-                    name = rows.iloc[0].Function
-                    try: EC = rows.iloc[0].EC
-                    except: pass
-                    try: gene = rows.iloc[0].Gene
-                    except: pass
-                annotate = [name, query, dbname, eval, score, EC, gene, orf_start, orf_end, start, end, end-start, length]
+                query,eval,score,length_orf,start,end,dbname = hits[0]
+                name,EC,gene = dfLookup[dbname].get(query, ("", "", ""))
+                annotate = [name, query, dbname, eval, score, EC, gene, orf_start, orf_end, start, end, end-start, length_orf]
                 print(target, *annotate, sep='\t', file=writer)
 
                 # Write to FAA file
-                faa_reader.seek(protein_index[target])
-                print(f">{target}", name, file=faa_writer)
-                for line in faa_reader:
-                    if line.startswith('>'):
-                        break
-                    faa_writer.write(line)
+                faa_writer.write(f">{target} {name}\n".encode())
+                faa_writer.write(fasta_index.lines(target))
                 annotate = list()
 
                 # Individual matches
                 annotations = dict() # TODO: this can probably be a set instead of dict
-                for match in hmmHits[target]:
+                for match in hits:
                     query,eval,score,length_orf,start,end,dbname = match
-                    rows = pd.DataFrame(dfLookup[dbname][dfLookup[dbname].ID==query])
-                    name,EC, gene = ["", "", ""]
-                    if not rows.empty:
-                        name = rows.iloc[0].Function
-                        try: EC = rows.iloc[0].EC
-                        except: pass
-                        try: gene = rows.iloc[0].Gene
-                        except: pass
+                    name,EC,gene = ["", "", ""]
+                    match = dfLookup[dbname].get(query)
+                    if match:
+                        name,EC,gene = match
                     else:
                         print("WARNING, query not in lookup:", target, dbname, query)
                     # add match to corresponding file
@@ -163,25 +178,23 @@ def getStats(faa:str, hmm_tsv:dict, dfCount:dict, config:dict, dbhmms:dict, summ
                 for dbname in dbhmms.keys():
                     print(target, "Hypothetical", *empty[1:], sep='\t', file=hmmFiles[dbname])
                 # Write to FAA file
-                faa_reader.seek(protein_index[target])
-                print(f">{target}", "Hypothetical", file=faa_writer)
-                for line in faa_reader:
-                    if line.startswith('>'):
-                        break
-                    faa_writer.write(line)
+                faa_writer.write(f">{target} Hypothetical\n".encode())
+                faa_writer.write(fasta_index.lines(target))
                 annotate = list()
     del dfLookup
     for v in hmmFiles.values():
         v.close()
+    if fasta_index is not None:
+        fasta_index.close()
 
     # calculate stats
-    lengths = [ item['length'] for item in proteins.values() ]
-    found = [ v['found'] for k,v in proteins.items() if v['found']>1 ]
+    lengths = protein_length.tolist()
+    found = int(np.count_nonzero(found > 1))
 
     stats = {
-        "Protein Count (Total)": len(proteins),
-        f"Protein Count (>Min Score)": len(found),
-        "% Proteins > Min Score": 0 if not len(proteins) else round(100.0*len(found)/len(proteins), 2),
+        "Protein Count (Total)": len(protein_index),
+        f"Protein Count (>Min Score)": found,
+        "% Proteins > Min Score": 0 if not len(protein_index) else round(100.0*found/len(protein_index), 2),
         "Average Protein Length": 0 if not len(lengths) else round(stat.mean(lengths), 2)
     }
     for dbName,filepath in dfCount.items():
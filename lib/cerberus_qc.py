@@ -6,6 +6,8 @@ Uses FastQC [https://www.bioinformatics.babraham.ac.uk/projects/fastqc/]
 import os
 import subprocess
 
+from . import cerberus_compress
+
 
 ## Check quality
 def checkQuality(rawRead, config, subdir):
@@ -24,7 +26,7 @@ def checkSingleRead(singleRead, config, subdir):
     try:
         with open(f"{path}/stdout.txt", 'w') as fout, open(f"{path}/stderr.txt", 'w') as ferr:
             subprocess.run(command, shell=True, check=True, stdout=fout, stderr=ferr)
-        return os.path.join(path, os.path.splitext(os.path.basename(singleRead))[0]+'_fastqc.html')
+        return os.path.join(path, cerberus_compress.splitExt(singleRead)[0]+'_fastqc.html')
     except Exception as e:
         print(e)
 
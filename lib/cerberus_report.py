@@ -15,12 +15,18 @@ import shutil
 import base64
 import re
 from dominate.util import raw
+import numpy as np
 import pandas as pd
 import pkg_resources as pkg
 import plotly.express as px
 import dominate
 from dominate.tags import *
 
+from . import cerberus_compress
+from . import cerberus_faidx
+from . import cerberus_prostats
+from . import cerberus_visual
+
 
 # standard html header to include plotly script
 htmlHeader = [
@@ -41,13 +47,20 @@ ICON = base64.b64encode(pkg.resource_stream('cerberus_x', 'cerberus_logo.jpg').r
 PLOTLY = pkg.resource_filename('cerberus_x', 'plotly-2.0.0.min.js')
 
 
+######### Copy Plotly ##########
+def copyPlotly(config, subdir):
+    '''Copies the plotly script used by the HTML reports, once before the reports of the samples are written in parallel.'''
+    path = f"{config['DIR_OUT']}/{subdir}"
+    os.makedirs(path, exist_ok=True)
+    shutil.copy(PLOTLY, path)
+    return
+
+
 ######### Create Report ##########
 def createReport(figSunburst, figCharts, config, subdir):
     path = f"{config['DIR_OUT']}/{subdir}"
     os.makedirs(path, exist_ok=True)
 
-    shutil.copy(PLOTLY, path)
-    
     # Sunburst HTML files
     for sample,figures in figSunburst.items():
         outpath = os.path.join(path, sample)
@@ -137,6 +150,17 @@ def write_Stats(outpath:os.PathLike, readStats:dict, protStats:dict, NStats:dict
             dictStats[key]["N-repeat Total Length"] = sum(repeats)
             dictStats[key]["N-repeat Average "] = round(sum(repeats)/len(repeats), 2)
 
+    # Contigs skipped by gene calling, shorter than --min-contig-length
+    for key in dictStats:
+        try:
+            infile = os.path.join(config['DIR_OUT'], config['STEP'][7], key, "short_contigs.tsv")
+            with open(infile) as reader:
+                reader.readline() # Skip header
+                min_length,contigs,bases = reader.readline().split()
+            dictStats[key]["Short Contigs Skipped"] = int(contigs)
+            dictStats[key]["Short Contigs Total Length"] = int(bases)
+        except: pass
+
 
     # Write Combined Stats to File
     outfile = os.path.join(outpath, "combined", "stats.tsv")
@@ -364,25 +388,104 @@ def write_HTML_files(outfile, figure, sample, name):
     return
 
 
+# ORIGIN block of a GenBank record
+def formatOrigin(sequence:bytes):
+    '''Formats a sequence as numbered lines of six blocks of ten bases.
+
+    Full lines are laid out in a single array, only the last line is formatted in Python.
+    '''
+    rows = len(sequence) // 60
+    if len(sequence) >= 999999900: # line numbers wider than the column
+        rows = 0
+    lines = np.full((rows, 76), ord(' '), dtype=np.uint8)
+    if rows:
+        # right aligned line numbers
+        starts = np.arange(rows, dtype=np.int64) * 60 + 1
+        for i in range(9):
+            digits = starts // 10**i
+            lines[:, 8-i] = np.where(digits > 0, ord('0') + digits % 10, ord(' '))
+        # bases in blocks of ten, followed by a space or the end of the line
+        blocks = lines[:, 10:].reshape(rows, 6, 11)
+        blocks[:, :, :10] = np.frombuffer(sequence, dtype=np.uint8, count=rows*60).reshape(rows, 6, 10)
+        lines[:, 75] = ord('\n')
+    origin = [lines.tobytes().decode()]
+    start = rows*60 + 1
+    row = list()
+    for s in range(rows*60, len(sequence), 10):
+        row += [sequence[s:s+10].decode()]
+        if len(row) == 6:
+            origin += [f'{start:>9} {" ".join(row)}\n']
+            row = list()
+            start += 60
+    origin += [f'{start:>9} {" ".join(row)}\n']
+    return ''.join(origin)
+
+
+# Write the GenBank records of a list of contigs
+def write_genbank(fna_idx:cerberus_faidx.FastaIndex, faa_idx:cerberus_faidx.FastaIndex, features:Path, spans:dict, contigs:list, out_genbank:Path):
+    '''Writes the GenBank records of the contigs, reading the sequences from the byte offsets of the open indexes.'''
+    with open(features, 'rb') as read_features, out_genbank.open('w') as writer_gbk:
+        for contig in contigs:
+            locus = fna_idx.header(contig)
+            length = fna_idx.length(contig)
+            print(f"{'LOCUS':<12}{locus:<12} {length} bp", file=writer_gbk)
+            print(f"{'DEFINITION':<12}", file=writer_gbk)
+            print(f"{'ACCESSION':<12}", file=writer_gbk)
+            print(f"{'VERSION':<12}", file=writer_gbk)
+            print(f"{'KEYWORDS':<12}", file=writer_gbk)
+            print(f"{'SOURCE':<12}", file=writer_gbk)
+            print(f"{'  ORGANISM':<12}", file=writer_gbk)
+            print(f"{'REFERENCE':<12}1", file=writer_gbk)
+            print(f"{'  AUTHORS':<12}", file=writer_gbk)
+            print(f"{'  TITLE':<12}", file=writer_gbk)
+            print(f"{'  JOURNAL':<12}", file=writer_gbk)
+            print(f"{'  PUBMED':<12}", file=writer_gbk)
+            print(f"{'COMMENT':<12}", file=writer_gbk)
+            print(f"{'FEATURES':<21}Location/Qualifiers", file=writer_gbk)
+            print(f'{"     source":<21}{f"1..{length}"}', file=writer_gbk)
+            print(f'{"":<21}/organism=""', file=writer_gbk)
+            # features of the contig saved from the GFF
+            for span_start,span_end in spans.get(contig, []):
+                read_features.seek(span_start)
+                for feature in read_features.read(span_end-span_start).decode().splitlines():
+                    start,end,strand,phase,product,dbxref,ID = feature.split('\t')
+                    if strand == '+':
+                        print(f'{"     CDS":<21}{f"{start}..{end}"}', file=writer_gbk)
+                    else:
+                        print(f'{"     CDS":<21}{f"complement ({start}..{end})"}', file=writer_gbk)
+                    print(f'{"":<21}/codon_start={int(phase)+1}', file=writer_gbk)
+                    print(f'{"":<21}/product="{product}"', file=writer_gbk)
+                    print(f'{"":<21}/db_xref="{dbxref}"', file=writer_gbk)
+                    # load translation from amino acid sequence file
+                    translation = f'/translation="'
+                    if ID in faa_idx:
+                        translation += faa_idx.sequence(ID).replace('*', '') + '"'
+                    for i in range(0, len(translation), 48):
+                        print(f'{"":<21}{translation[i:i+48]}', file=writer_gbk)
+            print(f'{"ORIGIN":<12}', file=writer_gbk)
+            writer_gbk.write(formatOrigin(fna_idx.sequence(contig, binary=True)))
+            print("//", file=writer_gbk)
+    return
+
+
 # Save Annotated GFF and GenBank files
 #TODO: Add embl
-def write_datafiles(gff:Path, fasta:Path, amino:Path, summary:Path, out_gff:Path, out_genbank:Path):
-    # Create amino acid index
-    faa_idx = dict()
-    with open(amino) as read_faa:
-        line_faa = read_faa.readline()
-        while line_faa:
-            if line_faa.startswith(">"):
-                line = line_faa.strip().split()[0][1:]
-                faa_idx[line] = read_faa.tell()
-            line_faa = read_faa.readline()
-
-    # Read in GFF data
-    gff_data = dict()
-    with out_gff.open('w') as writer_gff, out_gff.with_suffix(".gtf").open('w') as writer_gtf:
+def write_datafiles(gff:Path, fasta:Path, amino:Path, summary:Path, out_gff:Path, out_genbank:Path, cache:Path=None):
+    '''Writes the GFF and GTF annotated with the summary, and a GenBank template.
+
+    The GFF is streamed, keeping only the byte ranges of the features of each contig.
+    The GenBank records are written in the order of the contigs in the FASTA file,
+    which is indexed (and decompressed) once.
+    '''
+    # Annotate GFF, and save the features of each contig for the GenBank file
+    features = out_genbank.with_name(f"{out_genbank.name}.features.tmp")
+    spans = dict()
+    with out_gff.open('w') as writer_gff, out_gff.with_suffix(".gtf").open('w') as writer_gtf, features.open('wb') as writer_features:
         print("##gff-version 2", file=writer_gtf)
         with open(gff) as read_gff, summary.open() as read_summary:
             read_summary.readline()
+            contig = None
+            pos = 0
             for line in read_gff:
                 if line.startswith('#'):
                     writer_gff.write(line)
@@ -394,89 +497,95 @@ def write_datafiles(gff:Path, fasta:Path, amino:Path, summary:Path, out_gff:Path
                                         f"product_start={summ[10]}", f"product_end={summ[11]}", f"product_length={summ[12]}"]
                     print(*data, ';'.join(attributes), sep='\t', file=writer_gff)
                     print(*data, ';'.join(attributes), sep='\t', file=writer_gtf)
-                    if data[0] not in gff_data:
-                        gff_data[data[0]] = list()
-                    att = dict()
-                    for a in attributes:
-                        a = a.split('=')
-                        att[a[0]] = a[1]
-                    gff_data[data[0]] += [data + [att]]
-
-        # Write contigs to end of GFF (ROARY compatible)
+                    if data[0] != contig:
+                        contig = data[0]
+                        if contig not in spans:
+                            spans[contig] = list()
+                        spans[contig] += [[pos, pos]]
+                    # start, end, strand, phase, Name, Dbxref, ID
+                    att = [a.split('=')[1] for a in attributes[0:4]]
+                    feature = '\t'.join([data[3], data[4], data[6], data[7], att[1], att[3], att[0]]) + '\n'
+                    pos += writer_features.write(feature.encode())
+                    spans[contig][-1][1] = pos
+
+    # Write contigs to end of GFF (ROARY compatible)
+    with cerberus_faidx.FastaIndex(fasta, cache) as fna_idx, cerberus_faidx.FastaIndex(amino, cache) as faa_idx:
+        with out_gff.open('ab') as writer_gff:
+            writer_gff.write(b"##FASTA\n")
+            writer_gff.write(memoryview(fna_idx.data)[fna_idx.first():])
+
         # Create GENBANK template
-        print("##FASTA", file=writer_gff)
-        with open(fasta) as read_fasta, out_genbank.open('w') as writer_gbk:
-            locus = False
-            line = read_fasta.readline()
-            while line:
-                if line.startswith(">"):
-                    writer_gff.write(line)
-                    locus = line.strip()[1:]
-                    # read in sequence in fasta file
-                    seq_fna = list()
-                    line = read_fasta.readline()
-                    while line:
-                        if line.startswith(">"):
-                            break
-                        writer_gff.write(line)
-                        seq_fna += [line.strip()]
-                        line = read_fasta.readline()
-                    seq_fna = "".join(seq_fna)
-                    print(f"{'LOCUS':<12}{locus:<12} {len(seq_fna)} bp", file=writer_gbk)
-                    print(f"{'DEFINITION':<12}", file=writer_gbk)
-                    print(f"{'ACCESSION':<12}", file=writer_gbk)
-                    print(f"{'VERSION':<12}", file=writer_gbk)
-                    print(f"{'KEYWORDS':<12}", file=writer_gbk)
-                    print(f"{'SOURCE':<12}", file=writer_gbk)
-                    print(f"{'  ORGANISM':<12}", file=writer_gbk)
-                    print(f"{'REFERENCE':<12}1", file=writer_gbk)
-                    print(f"{'  AUTHORS':<12}", file=writer_gbk)
-                    print(f"{'  TITLE':<12}", file=writer_gbk)
-                    print(f"{'  JOURNAL':<12}", file=writer_gbk)
-                    print(f"{'  PUBMED':<12}", file=writer_gbk)
-                    print(f"{'COMMENT':<12}", file=writer_gbk)
-                    print(f"{'FEATURES':<21}Location/Qualifiers", file=writer_gbk)
-                    print(f'{"     source":<21}{f"1..{len(seq_fna)}"}', file=writer_gbk)
-                    print(f'{"":<21}/organism=""', file=writer_gbk)
-                    # get gff data
-                    locus = locus.split()[0]
-                    if locus in gff_data:
-                        for data in gff_data[locus]:
-                            attributes = data[-1]
-                            start = data[3]
-                            end = data[4]
-                            if data[6] == '+':
-                                print(f'{"     CDS":<21}{f"{start}..{end}"}', file=writer_gbk)
-                            else:
-                                print(f'{"     CDS":<21}{f"complement ({start}..{end})"}', file=writer_gbk)
-                            print(f'{"":<21}/codon_start={int(data[7])+1}', file=writer_gbk)
-                            print(f'{"":<21}/product="{attributes["Name"]}"', file=writer_gbk)
-                            print(f'{"":<21}/db_xref="{attributes["Dbxref"]}"', file=writer_gbk)
-                            # load translation from amino acid sequence file, using previously created index
-                            translation = f'/translation="'
-                            seq_faa = []
-                            if attributes["ID"] in faa_idx:
-                                with open(amino) as read_faa:
-                                    read_faa.seek(faa_idx[attributes["ID"]])
-                                    for line_faa in read_faa:
-                                        if line_faa.startswith(">"):
-                                            break
-                                        seq_faa += [line_faa.strip()]
-                                translation += re.sub(r'\*', "", ''.join(seq_faa)) + '"'
-                            for i in range(0, len(translation), 48):
-                                print(f'{"":<21}{translation[i:i+48]}', file=writer_gbk)
-                    print(f'{"ORIGIN":<12}', file=writer_gbk)
-                    row = list()
-                    start = 1
-                    for s in range(0, len(seq_fna), 10):
-                        row += [seq_fna[s:s+10]]
-                        if len(row) == 6:
-                            print(f'{start:>9} {" ".join(row)}', file=writer_gbk)
-                            row = list()
-                            start += 60
-                    print(f'{start:>9} {" ".join(row)}', file=writer_gbk)
-                    print("//", file=writer_gbk)
-                    continue
-                line = read_fasta.readline()
+        write_genbank(fna_idx, faa_idx, features, spans, list(fna_idx), out_genbank)
+    features.unlink()
 
     return
+
+
+# Final annotation summary and data files of a sample
+def write_sample(key:str, amino:Path, fasta:Path, hmm_tsv:dict, dfCount:dict, config:dict, dbhmms:dict, final_path:Path):
+    '''Writes the final reports of one sample.
+
+    Returns:
+        dict of protein statistics from cerberus_prostats.getStats
+    '''
+    Path(final_path, key).mkdir(0o777, True, True)
+    Path(final_path, "fasta").mkdir(0o777, True, True)
+    Path(final_path, "gff").mkdir(0o777, True, True)
+    # Copy report files from Parser
+    src = Path(config['DIR_OUT'], config['STEP'][9], key, f"HMMER_top_{config['TOP_HITS']}.tsv")
+    shutil.copy(src, Path(final_path, key))
+    # Protein statistics & annotation summary
+    summary_tsv = Path(final_path, key, 'final_annotation_summary.tsv')
+    protStats = cerberus_prostats.getStats(amino, hmm_tsv, dfCount, config, dbhmms, summary_tsv, Path(final_path, "fasta", f"{key}.faa"))
+    try:
+        src = Path(amino).with_suffix(".ffn")
+        dst = Path(final_path, "fasta", f"{key}.ffn")
+        shutil.copy(src, dst)
+    except: pass
+    try:
+        src = Path(fasta)
+        # keeps the compression of the input
+        suffix = src.suffix if cerberus_compress.compression(src) else ""
+        dst = Path(final_path, "fasta", f"{key}.fna{suffix}")
+        shutil.copy(src, dst)
+    except: pass
+    # Create GFFs
+    gff = [x for x in Path(config['DIR_OUT'], config['STEP'][7], key).glob("*.gff")]
+    out_gff = Path(final_path, "gff", f"{key}.gff")
+    if len(gff) == 1:
+        out_genbank = Path(final_path, f"{key}_template.gbk")
+        write_datafiles(gff[0], fasta, amino, summary_tsv, out_gff, out_genbank, config.get('DIR_INDEX'))
+    else:
+        with out_gff.open('w') as writer:
+            with summary_tsv.open() as read_summary:
+                read_summary.readline()
+                print("##gff-version  3", file=writer)
+                for summ in read_summary:
+                    summ = summ.split('\t')
+                    data = [summ[0].split('_')[0], ".", ".", ".", ".", ".", ".", ".", ]
+                    attributes = ';'.join([f"ID={summ[0]}", f"Name={summ[1]}", f"Alias={summ[2]}", f"Dbxref={summ[3]}", f"evalue={summ[4]}", f"product_start={summ[8]}", f"product_end={summ[9]}", f"product_length={summ[10]}"])
+                    print(*data, attributes, sep='\t', file=writer)
+            try:
+                with cerberus_compress.openFile(fasta) as read_fasta:
+                    print("##FASTA", file=writer)
+                    for line in read_fasta:
+                        writer.write(line)
+            except: pass
+    return protStats
+
+
+# Rollup tables and figures of a sample
+def write_sampleReport(key:str, rollup_files:dict, count_files:dict, config:dict, subdir:str, final_path:Path):
+    '''Writes the level tables, rollup files and HTML figures of one sample.'''
+    report_path = Path(config['DIR_OUT'], subdir, key)
+    report_path.mkdir(0o777, True, True)
+    Path(final_path, key).mkdir(0o777, True, True)
+    for name,table in count_files.items():
+        writeTables(table, f"{report_path}/{name}")
+    for name,table in rollup_files.items():
+        shutil.copy(table, Path(final_path, key, f'rollup_{name}.tsv'))
+    # Figure outputs (HTML)
+    figSunburst = {key: cerberus_visual.graphSunburst(count_files)}
+    figCharts = {key: cerberus_visual.graphBarcharts(rollup_files, count_files)}
+    createReport(figSunburst, figCharts, config, subdir)
+    return
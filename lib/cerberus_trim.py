@@ -4,10 +4,11 @@ Uses fastp [https://github.com/OpenGene/fastp#quality-filter]
 Uses porechop
 """
 
-import os
 from pathlib import Path
 import subprocess
 
+from . import cerberus_compress
+
 
 # Trim single end reads
 def trimSingleRead(key_value, config, subdir):
@@ -16,7 +17,8 @@ def trimSingleRead(key_value, config, subdir):
     key = key_value[0]
     value = key_value[1]
 
-    trimmedRead = path / f'trimmed_{key}.fastq'
+    # fastp and porechop compress the output by its extension
+    trimmedRead = path / f"trimmed_{key}{cerberus_compress.outputExt('.fastq', config.get('COMPRESS'))}"
 
     done = path / "complete"
     if not config['REPLACE'] and done.exists() and trimmedRead.exists():
@@ -25,6 +27,8 @@ def trimSingleRead(key_value, config, subdir):
     path.mkdir(exist_ok=True, parents=True)
 
     adapters = "" if not config['ADAPTERS'] else f"--adapter_fasta {config['ADAPTERS']}"
+    # zstd is not read by fastp and porechop
+    value = cerberus_compress.plainFile(value, path)
 
     if config['NANOPORE']:
         command = f"{config['EXE_PORECHOP']} -i {value} -o {trimmedRead} --threads {config['CPUS']}"
@@ -47,8 +51,9 @@ def trimPairedRead(key_value, config, subdir):
 
     key = key_value[0]
     value = key_value[1]
-    outR1 = f"trimmed_{os.path.basename(value[0])}"
-    outR2 = f"trimmed_{os.path.basename(value[1])}"
+    ext = cerberus_compress.outputExt('.fastq', config.get('COMPRESS'))
+    outR1 = f"trimmed_{cerberus_compress.splitExt(value[0])[0]}{ext}"
+    outR2 = f"trimmed_{cerberus_compress.splitExt(value[1])[0]}{ext}"
 
     trimmedReads = (Path(path, outR1), Path(path, outR2))
 
@@ -59,6 +64,8 @@ def trimPairedRead(key_value, config, subdir):
     path.mkdir(exist_ok=True, parents=True)
 
     adapters = "" if not config['ADAPTERS'] else f"--adapter_fasta {config['ADAPTERS']}"
+    # zstd is not read by fastp
+    value = [cerberus_compress.plainFile(value[0], path), cerberus_compress.plainFile(value[1], path)]
 
     command = f"{config['EXE_FASTP']} -i {value[0]} -I {value[1]} -o {trimmedReads[0]} -O {trimmedReads[1]} -p 20 -M 30 -q 30 --low_complexity_filter {adapters} -h {path}/fastp.{key}.html -j {path}/fastp.{key}.json"
     try:
@@ -54,7 +54,7 @@ setuptools.setup(
             'plotly',
             'psutil',
             'dominate',
-            'pyrodigal',
+            'pyrodigal>=3,<4',
             'pyrodigal-gv',
             'pyhmmer'
             ],